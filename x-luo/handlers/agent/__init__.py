@@ -1,73 +1,117 @@
 #!/usr/bin/python
-import Queue
+# coding=utf-8
 import threading
 import time
-import json
+import logging
 from moniItems import mon
+from scheduler import Scheduler
 
-from xlib.utils.config import config
-from xlib.xnet.cnetutil import send_data
+from xlib.utils.config import config, subscribe, watch, reload_on_sighup
+from xlib.utils.spool import Spool
+from xlib.xnet.cnetutil import XClient, Rejected
 
 agent_conf = config('./conf','agent', 'global')
 
 
 class porterThread (threading.Thread):
-    def __init__(self, name, q, ql, interval=None):
+    def __init__(self, name, spool, interval=None):
         threading.Thread.__init__(self)
         self.name = name
-        self.q = q
+        # 采集的数据先写入磁盘缓存，发送成功后才删除
+        self.spool = spool
         self.setDaemon(1)
-        self.queueLock = ql
         self.interval = interval
+        self.client = None
 
     def run(self):
         #print "Starting %s"  % self.name
-        if self.name == 'collect':
-            self.put_data()
-        elif self.name == 'sendjson':
+        if self.name == 'sendjson':
             self.get_data()
 
-    def put_data(self):
-        m = mon()
-        atime = int(time.time())
-        while True:
-            data = m.runAllGet()
-            #print "put_data:",data
-            self.queueLock.acquire()
-            self.q.put(data)
-            self.queueLock.release()
-            btime = int(time.time())
-            #print '%s  %s' % (str(data), self.interval-((btime-atime)%30))
-            time.sleep(self.interval - ((btime - atime) % self.interval))
-
     def get_data(self):
-        try:
-            trans_l = agent_conf['trans_l'].split(';')
-            print trans_l
-            agent_sock_l = [None]
-        except BaseException:
-            pass
+        client = None
+        while client is None:
+            try:
+                trans_l = agent_conf['trans_l'].split(';')
+                print trans_l
+                # 和所有传输服务器保持长连接，按 balance 均衡发送
+                client = XClient(trans_l,
+                                 balance=agent_conf.get('balance', 'round_robin'),
+                                 version=int(agent_conf.get('version', 1)),
+                                 compress=agent_conf.get('compress', '0') == '1',
+                                 codec=agent_conf.get('codec', 'json'),
+                                 secret_key=agent_conf.get('secret_key') or None)
+            except Exception as msg:
+                # 配置错误时等待 interval 后重试（配置文件修改后重新加载生效），
+                # 数据留在磁盘缓存中
+                logging.error("***sendjson: create client error(%s)***" % msg)
+                time.sleep(self.interval)
+        self.client = client
         while True:
-            self.queueLock.acquire()
-            if not self.q.empty():
-                data = self.q.get()
-                #print "get:",data
-                send_data(trans_l, json.dumps(data), agent_sock_l)
-            self.queueLock.release()
+            # 从磁盘缓存按顺序读出一个批次，发送成功后才提交读取位置，
+            # 发送失败时下次从同一个位置重发
+            # 批次大小每次从配置中读取，配置文件重新加载后立即生效
+            batch, cursor = self.spool.read(
+                agent_conf.getint('batch_count', 100),
+                agent_conf.getint('batch_bytes', 64 * 1024))
+            if not batch:
+                # 阻塞等待新数据，采集写入后立即唤醒发送
+                self.spool.wait(self.interval)
+                continue
+            # 一个批次是每行一个样本的 json，一次发送，服务端整体确认
+            # 积压的数据（比如服务端维护结束后）不等待，连续发送直到追上
+            try:
+                if client.send("\n".join(batch)):
+                    self.spool.commit(cursor)
+                    continue
+            except Rejected as msg:
+                # 数据有错误，重发也不会成功，隔离后继续发送后面的数据
+                self.spool.reject(batch, cursor)
+                continue
+            # 发送失败，等待 interval 后重试
             time.sleep(self.interval)
 
+    def set_hosts(self, trans_l):
+        '''配置重新加载后更新传输服务器列表'''
+        if self.client is not None:
+            self.client.set_hosts(trans_l)
+
 
 def main():
-    q1 = Queue.Queue(10)
-    ql1 = threading.Lock()
-    collect = porterThread('collect', q1, ql1, interval=3)
+    spool = Spool(agent_conf.get('spool_dir', './spool'),
+                  int(agent_conf.get('spool_segment', 4 * 1024 * 1024)),
+                  int(agent_conf.get('spool_max', 256 * 1024 * 1024)))
+    # 采集调度，每个采集项按自己的间隔执行
+    collect = Scheduler(spool, int(agent_conf.get('window', 0)))
+    collector = collect.add('mon', mon().runAllGet,
+                            float(agent_conf.get('collect_interval', 3)),
+                            agent_conf.get('collect_policy', 'spool'))
     collect.start()
-    time.sleep(0.5)
-    sendjson = porterThread('sendjson', q1, ql1, interval=3)
+    sendjson = porterThread('sendjson', spool,
+                            interval=float(agent_conf.get('retry_interval', 3)))
     sendjson.start()
 
+    def reload(changes):
+        '''配置文件修改后不重启更新传输服务器列表、间隔和 window
+        采集间隔在下一次采集后生效
+        '''
+        keys = changes.get('global', ())
+        if 'trans_l' in keys:
+            sendjson.set_hosts(agent_conf.getlist('trans_l'))
+        if 'collect_interval' in keys:
+            collector.interval = agent_conf.getfloat('collect_interval', 3)
+        if 'retry_interval' in keys:
+            sendjson.interval = agent_conf.getfloat('retry_interval', 3)
+        if 'window' in keys:
+            collect.window = agent_conf.getint('window', 0)
+    subscribe('./conf', 'agent', reload)
+    watch(agent_conf.getfloat('watch_interval', 5))
+    reload_on_sighup()
+
     #print  "start"
-    collect.join()
+    # join 带超时，主线程才能执行 SIGHUP 的处理函数
+    while collect.is_alive():
+        collect.join(1)
     sendjson.join()
 
 
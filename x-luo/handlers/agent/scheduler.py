@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""agent 采集调度
+每个采集项有自己的执行间隔，调度线程按最近的到期时间阻塞等待（不轮询），
+到期后执行采集，结果写入 spool，spool 唤醒发送线程立即发送
+
+spool 中未确认的数据超过 window 字节时（服务端不可用或者发送跟不上），
+按采集项的策略处理新数据：
+    spool    照常写入（只受 spool 磁盘上限限制，默认）
+    drop     丢弃新数据
+    coalesce 只在内存中保留最新的一条，window 有空间后再写入
+"""
+import time
+import json
+import heapq
+import logging
+import itertools
+import threading
+
+POLICY_SPOOL = "spool"
+POLICY_DROP = "drop"
+POLICY_COALESCE = "coalesce"
+POLICIES = (POLICY_SPOOL, POLICY_DROP, POLICY_COALESCE)
+
+
+class Collector(object):
+    '''采集项
+    func: 采集函数，返回可以 json 序列化的数据
+    interval: 执行间隔（秒）
+    '''
+
+    def __init__(self, name, func, interval, policy=POLICY_SPOOL):
+        if policy not in POLICIES:
+            raise ValueError("unknown policy %r" % policy)
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.policy = policy
+        # coalesce 时等待写入的最新数据
+        self.pending = None
+        # 因为 window 已满丢弃（包括被合并）的数据条数
+        self.dropped = 0
+
+
+class Scheduler(threading.Thread):
+    '''采集调度线程
+    spool: 采集结果写入的 Spool
+    window: spool 中未确认数据的字节上限，0 为不限制
+    '''
+
+    def __init__(self, spool, window=0):
+        threading.Thread.__init__(self)
+        self.setDaemon(1)
+        self.spool = spool
+        self.window = window
+        # (下次执行时间, 序号, 采集项) 的最小堆
+        self.heap = []
+        self.seq = itertools.count()
+        self.stopped = threading.Event()
+
+    def add(self, name, func, interval, policy=POLICY_SPOOL):
+        '''添加采集项，启动后立即执行一次'''
+        collector = Collector(name, func, interval, policy)
+        heapq.heappush(self.heap, (time.time(), next(self.seq), collector))
+        return collector
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while self.heap and not self.stopped.is_set():
+            deadline, seq, collector = self.heap[0]
+            now = time.time()
+            if deadline > now:
+                # 等到最近的采集项到期，stop 时立即返回
+                self.stopped.wait(deadline - now)
+                continue
+            heapq.heapreplace(self.heap, (
+                self.next_deadline(collector, deadline, now), seq, collector))
+            self.collect(collector)
+
+    def next_deadline(self, collector, deadline, now):
+        '''按固定频率计算下次执行时间，落后超过一个间隔时跳过错过的次数'''
+        deadline += collector.interval
+        if deadline <= now:
+            missed = int((now - deadline) // collector.interval) + 1
+            deadline += missed * collector.interval
+        return deadline
+
+    def collect(self, collector):
+        '''执行采集并写入，采集失败不影响其他采集项'''
+        try:
+            line = json.dumps(collector.func())
+        except Exception as msg:
+            logging.warning("***collector %s error(%s)***" % (collector.name, msg))
+            return
+        self.offer(collector, line)
+
+    def offer(self, collector, line):
+        '''按 window 和采集项的策略写入 spool'''
+        if collector.policy == POLICY_SPOOL or not self.window \
+                or len(self.spool) < self.window:
+            if collector.pending is not None:
+                self.spool.append(collector.pending)
+                collector.pending = None
+            self.spool.append(line)
+            return
+        if collector.policy == POLICY_COALESCE:
+            if collector.pending is not None:
+                collector.dropped += 1
+            collector.pending = line
+        else:
+            collector.dropped += 1
+        if collector.dropped and collector.dropped % 100 == 1:
+            logging.warning("***collector %s: window full, %d samples dropped***" %
+                            (collector.name, collector.dropped))
@@ -1,12 +1,19 @@
 #!/usr/bin/env python
 # coding=utf-8
 
-import json
+import os
+import time
 import logging
+import threading
 
-from xlib.utils.config import config
-from xlib.xnet.snetframework import XNet
-from xlib.xnet.snetbase import bind_socket
+from xlib.utils.config import config, subscribe, watch, reload_on_sighup
+from xlib.utils.ingestlog import IngestLog
+from xlib.utils.tsstore import Store
+from xlib.utils.tsquery import QueryEngine
+from xlib.xnet.netframe import MSG_QUERY, REPLY_OK, REPLY_ERR, REPLY_REJECT
+from xlib.xnet.codec import FEATURE_BIN, Record, decode, log_line
+from xlib.xnet.snetframework import XNet, run_workers
+from xlib.xnet.snetbase import bind_socket, Deferred
 
 import xlib.blog
 
@@ -14,26 +21,151 @@ xlib.blog.init_log("./log/xnet")
 
 # 导入配置文件
 trans_conf = config('./conf','server', 'server')
+xlib.blog.set_level(trans_conf.get('log_level', 'info'))
+
+# 接收数据的存储日志，每个进程一个（多进程时 fork 之后在各自的进程中创建）
+ingest_log = None
+ingest_pid = None
+ingest_lock = threading.Lock()
+durable = trans_conf.get('durable', '0') == '1'
+durable_timeout = float(trans_conf.get('durable_timeout', 10))
+
+# 最近数据的内存时序存储，每个进程保存自己收到的数据
+ts_store = Store(int(trans_conf.get('ts_capacity', 1200)),
+                 int(trans_conf.get('ts_retention', 3600)),
+                 trans_conf.get('ts_value_type', 'f'))
+# 查询内存时序数据（v2 协议的 MSG_QUERY 帧），结果有缓存
+query_engine = QueryEngine(ts_store, int(trans_conf.get('query_cache', 1024)),
+                           float(trans_conf.get('query_window_step', 5)))
+
+
+def storage():
+    '''当前进程的存储日志'''
+    global ingest_log, ingest_pid
+    if ingest_pid != os.getpid():
+        # logic 可能在线程池中同时执行
+        with ingest_lock:
+            if ingest_pid != os.getpid():
+                ingest_log = IngestLog(
+                    trans_conf.get('log_dir', './data'),
+                    int(trans_conf.get('log_segment_size', 64 * 1024 * 1024)),
+                    int(trans_conf.get('log_segment_time', 3600)),
+                    float(trans_conf.get('fsync_interval', 1)))
+                ingest_pid = os.getpid()
+    return ingest_log
+
 
 # 处理程序
 def logic(data):
     # 打印接收到的数据
     #print data
-    f1 = open('/tmp/test.txt','a')
-    f1.write(data)
-    f1.write('\n')
-    f1.close()
-    data = json.loads(data)
-    return("OK")
+    # agent 批量发送时每行一个 json 样本（或者协商后的二进制编码），先全部解析，
+    # 有错误时整批拒绝（REJECT，agent 隔离这一批不再重发），都正确时一次写入再返回 OK，
+    # 一个批次要么全部写入要么都不写入；暂时的失败返回 ERR，agent 稍后重发
+    # 写入内存时序数据的检查（主机名、时间范围等）在写存储日志之前，不能写入的批次不进日志
+    # 二进制编码的样本不创建字典，检查时 Record.metrics 取出数值并检查整个样本的内容
+    now = time.time()
+    try:
+        samples = decode(data)
+        prepared = [ts_store.prepare(sample, now) for sample in samples
+                    if isinstance(sample, (dict, Record))]
+    except ValueError as msg:
+        logging.info("***bad sample(%s) reject batch***" % msg)
+        return(REPLY_REJECT)
+    # 只放进存储日志的队列，由写线程批量写入，不阻塞 epoll 循环
+    # 二进制编码的数据块 base64 后作为一行写入（codec.parse_log_line 读取）
+    ticket = storage().append(log_line(data) + '\n', durable)
+    for item in prepared:
+        ts_store.insert(item, now)
+    if ticket is None:
+        return(REPLY_OK)
+    # durable 时等数据 fsync 后再返回 OK，不占用线程等待：写线程落盘（或者写入失败）后
+    # 通知 epoll 线程发送返回，durable_timeout 秒内没有落盘返回 ERR，客户端会重发
+    deferred = Deferred(durable_timeout, REPLY_ERR)
+    ticket.add_callback(
+        lambda ticket: deferred.done(REPLY_OK if ticket.ok else REPLY_ERR))
+    return deferred
+
+# 查询处理程序
+def query(data):
+    return query_engine(data)
+
+
+def reload(changes):
+    '''配置文件修改后不重启更新日志级别、落盘等待时间、fsync 间隔、时序数据保留时间和查询缓存时间
+    只更新当前进程（pool=process 时进程池中的进程不会更新）
+    '''
+    global durable_timeout
+    keys = changes.get('server', ())
+    if 'log_level' in keys:
+        xlib.blog.set_level(trans_conf.get('log_level', 'info'))
+    if 'durable_timeout' in keys:
+        durable_timeout = trans_conf.getfloat('durable_timeout', 10)
+    if 'fsync_interval' in keys and ingest_log is not None:
+        ingest_log.fsync_interval = trans_conf.getfloat('fsync_interval', 1)
+    if 'ts_retention' in keys:
+        ts_store.retention = trans_conf.getint('ts_retention', 3600)
+    if 'query_window_step' in keys:
+        query_engine.window_step = trans_conf.getfloat('query_window_step', 5)
+
+
+def watch_config():
+    '''启动配置文件检查线程（多进程时在每个子进程中执行）'''
+    watch(trans_conf.getfloat('watch_interval', 5))
+
 
 def main():
     # 监听地址和端口
     addr = trans_conf['addr']
     port = int(trans_conf['port'])
+    backlog = int(trans_conf.get('backlog', 10))
+    # epoll 触发模式
+    edge = trans_conf.get('edge', '0') == '1'
+    budget = int(trans_conf.get('budget', 16))
+    # 连接超时
+    timeouts = {}
+    for name in ('head', 'body', 'idle', 'write'):
+        key = 'timeout_%s' % name
+        if key in trans_conf:
+            timeouts[name] = int(trans_conf[key])
+    # 处理程序执行方式
+    pool = trans_conf.get('pool') or None
+    pool_size = int(trans_conf.get('pool_size', 0))
+    max_frame = int(trans_conf.get('max_frame', 16 * 1024 * 1024))
+    compress = trans_conf.get('compress', '1') == '1'
+    # 允许客户端协商的二进制编码
+    features = [FEATURE_BIN] if trans_conf.get('codec_bin', '1') == '1' else []
+    # 连接加密
+    secret_key = trans_conf.get('secret_key') or None
+    encrypt_only = trans_conf.get('encrypt_only', '0') == '1'
+
+    # 配置文件修改（或者收到 SIGHUP）时重新加载
+    subscribe('./conf', 'server', reload)
+    reload_on_sighup()
+
+    # 多进程时每个进程只有自己收到的数据，查询结果标记为不完整
+    reuseport = trans_conf.get('reuseport', '0') == '1'
+    if reuseport or pool == 'process':
+        query_engine.partial = True
+        logging.warning("multi-process server, query results are partial")
+
+    # 多进程启动
+    if reuseport:
+        workers = int(trans_conf.get('workers', 0))
+        run_workers(addr, port, logic, workers, backlog, init=watch_config,
+                    edge=edge, budget=budget, timeouts=timeouts,
+                    pool=pool, pool_size=pool_size, max_frame=max_frame,
+                    compress=compress, handlers={MSG_QUERY: query},
+                    features=features, secret_key=secret_key,
+                    encrypt_only=encrypt_only)
+        return
 
     # 启动服务
-    sock = bind_socket(addr, port)
-    transD = XNet(sock, logic)
+    watch_config()
+    sock = bind_socket(addr, port, backlog)
+    transD = XNet(sock, logic, edge, budget, timeouts, pool, pool_size,
+                  max_frame, compress, {MSG_QUERY: query}, features,
+                  secret_key, encrypt_only)
     transD.run()
 if __name__ == '__main__':
     main()
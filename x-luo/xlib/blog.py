@@ -196,6 +196,25 @@ def init_log(log_path, level=logging.INFO, when="D", backup=7,
     logger.addHandler(handler)
 
 
+def set_level(level):
+    """
+    set_level - change the level of the log initialized by init_log
+
+    Args:
+      level         - logging level or level name such as "debug"
+                      the .log.wf file always keeps WARNING and above
+    """
+    if not isinstance(level, int):
+        level = logging.getLevelName(str(level).upper())
+        if not isinstance(level, int):
+            raise ValueError("unknown log level")
+    logger = logging.getLogger()
+    logger.setLevel(level)
+    for handler in logger.handlers:
+        if getattr(handler, "baseFilename", "").endswith(".log"):
+            handler.setLevel(level)
+
+
 if __name__ == "__main__":
     # 通用模块日志
     init_log("./log/common.log")
@@ -1,31 +1,239 @@
 # coding=utf-8
 
+"""读取 ini 配置文件
+每个文件只解析一次，section 缓存在 registry 中，多次调用 config() 返回同一个字典（Section），
+配置文件修改后重新加载时原地更新这个字典，持有它的模块直接看到新的值，
+并通知订阅了这个文件的函数，用于在不重启的情况下更新传输服务器列表、间隔时间、日志级别等：
+
+    conf = config('./conf', 'agent', 'global')
+    conf.getint('batch_count', 100)
+    subscribe('./conf', 'agent', on_change)   # on_change({section: set(changed keys)})
+    watch(5)                                  # 每 5 秒检查一次文件是否修改
+    reload_on_sighup()                        # 收到 SIGHUP 时立即重新加载
+
+只在启动时使用的配置（如监听端口、进程数）修改后仍然需要重启
+"""
+import os
+import signal
+import logging
+import threading
 import ConfigParser
 
 # 当前工作目录的绝对路径
 # work_path = os.path.dirname(os.path.realpath(__file__))
 
+# 检查文件修改的间隔（秒）
+WATCH_INTERVAL = 5
+TRUE_VALUES = ("1", "true", "yes", "on")
+
+
+class Section(dict):
+    '''一个 section 的配置，值都是字符串，get* 方法按类型转换'''
+
+    def getint(self, key, default=None):
+        value = self.get(key)
+        return default if value in (None, "") else int(value)
+
+    def getfloat(self, key, default=None):
+        value = self.get(key)
+        return default if value in (None, "") else float(value)
+
+    def getbool(self, key, default=False):
+        value = self.get(key)
+        return default if value in (None, "") else value.lower() in TRUE_VALUES
+
+    def getlist(self, key, sep=";", default=None):
+        value = self.get(key)
+        if value in (None, ""):
+            return default if default is not None else []
+        return [item.strip() for item in value.split(sep) if item.strip()]
+
+    def replace(self, data):
+        '''原地更新成 data，返回变化的 key 集合
+        先写入新的值再删除去掉的 key，读取的线程不会看到缺少 key 的中间状态
+        '''
+        changed = set(key for key in data if self.get(key) != data[key])
+        removed = set(self) - set(data)
+        self.update((key, data[key]) for key in changed)
+        for key in removed:
+            self.pop(key, None)
+        return changed | removed
+
+
+class ConfigFile(object):
+    '''一个配置文件的缓存'''
+
+    def __init__(self, path):
+        self.path = path
+        # 文件的 (mtime, size, inode)，用于判断是否修改
+        self.stamp = None
+        self.sections = {}
+        self.subscribers = []
+
+    def stat(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_mtime, st.st_size, st.st_ino
+
+    def parse(self):
+        '''读取文件，返回 {section: {key: value}}'''
+        # 使用ConfigParser读取ini配置文件
+        cf = ConfigParser.ConfigParser()
+        # 在构造对象之后设置 optionxform 属性为 str 即可区别保留大小写
+        cf.optionxform = str
+        cf.read(self.path)
+        return dict((name, dict(cf.items(name))) for name in cf.sections())
+
+    def load(self):
+        '''重新读取文件并原地更新所有 section，返回 {section: 变化的 key 集合}
+        格式错误时抛出 ConfigParser.Error，文件再次修改前不再重新读取
+        '''
+        self.stamp = self.stat()
+        data = self.parse()
+        changes = {}
+        for name in set(data) | set(self.sections):
+            section = self.sections.get(name)
+            if section is None:
+                section = self.sections[name] = Section()
+            changed = section.replace(data.get(name, {}))
+            if changed:
+                changes[name] = changed
+        return changes
+
+
+class Registry(object):
+    '''配置文件的缓存，线程安全'''
+
+    def __init__(self):
+        # 文件的绝对路径 -> ConfigFile
+        self.files = {}
+        self.lock = threading.RLock()
+        # 检查线程和启动它的进程（fork 之后的子进程中没有这个线程）
+        self.thread = None
+        self.pid = None
+        self.interval = WATCH_INTERVAL
+        self.wakeup = threading.Event()
+
+    def file(self, conf_path, conf_file):
+        '''取出配置文件，第一次使用时读取'''
+        path = os.path.abspath("%s/%s" % (conf_path, conf_file))
+        with self.lock:
+            conf = self.files.get(path)
+            if conf is None:
+                conf = ConfigFile(path)
+                conf.load()
+                self.files[path] = conf
+            return conf
+
+    def get(self, conf_path, conf_file, conf_name=None):
+        '''和 config() 相同'''
+        conf = self.file(conf_path, conf_file)
+        with self.lock:
+            if conf_name:
+                if conf_name not in conf.sections:
+                    raise ConfigParser.NoSectionError(conf_name)
+                return conf.sections[conf_name]
+            return sorted(conf.sections)
+
+    def subscribe(self, conf_path, conf_file, callback):
+        '''文件重新加载并且有变化时调用 callback({section: 变化的 key 集合})
+        callback 在检查线程中执行，不要长时间阻塞
+        '''
+        conf = self.file(conf_path, conf_file)
+        with self.lock:
+            conf.subscribers.append(callback)
+
+    def check(self, force=False):
+        '''检查所有文件，修改过的（force 时所有的）重新加载并通知订阅者
+        文件不存在或者格式错误时保留原来的配置
+        '''
+        notify = []
+        with self.lock:
+            for conf in self.files.values():
+                stamp = conf.stat()
+                if stamp is None or (stamp == conf.stamp and not force):
+                    continue
+                try:
+                    changes = conf.load()
+                except ConfigParser.Error as msg:
+                    logging.error("***config: reload %s error(%s)***" %
+                                  (conf.path, msg))
+                    continue
+                if changes:
+                    logging.warning("config: reload %s %s" % (
+                        conf.path, dict((name, sorted(keys))
+                                        for name, keys in changes.items())))
+                    notify.append((conf, changes))
+        for conf, changes in notify:
+            for callback in list(conf.subscribers):
+                try:
+                    callback(changes)
+                except Exception as msg:
+                    logging.error("***config: %s subscriber error(%s)***" %
+                                  (conf.path, msg))
+        return [conf.path for conf, changes in notify]
+
+    def watch(self, interval=WATCH_INTERVAL):
+        '''启动检查线程，每 interval 秒检查一次文件是否修改
+        多进程时需要在 fork 之后的每个子进程中调用
+        '''
+        self.interval = interval
+        with self.lock:
+            if self.thread is not None and self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self.run)
+            self.thread.setDaemon(1)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            # SIGHUP 时提前唤醒并强制重新加载
+            force = self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.check(force)
+
+    def sighup(self, signum=None, frame=None):
+        '''SIGHUP 处理函数，有检查线程时交给线程，否则在新的线程中重新加载
+        （信号处理函数在主线程中执行，主线程可能正持有 self.lock）
+        '''
+        if self.thread is not None and self.pid == os.getpid():
+            self.wakeup.set()
+        else:
+            thread = threading.Thread(target=self.check, args=(True,))
+            thread.setDaemon(1)
+            thread.start()
+
+
+# 默认的配置缓存
+registry = Registry()
+
 
 def config(conf_path, conf_file, conf_name=None):
     '''
     conf_path: 配置文件路径
     conf_file: 配置文件的名称
     conf_name: 配置文件中项目的名称,如果为空择显示文件中有哪些配置名称
+    返回的 Section 是缓存的，配置文件重新加载后原地更新
+    '''
+    return registry.get(conf_path, conf_file, conf_name)
+
+
+def subscribe(conf_path, conf_file, callback):
+    registry.subscribe(conf_path, conf_file, callback)
+
+
+def watch(interval=WATCH_INTERVAL):
+    registry.watch(interval)
+
+
+def reload_on_sighup():
+    '''收到 SIGHUP 时重新加载所有配置文件（需要在主线程中调用）
+    多进程时向所有进程发送 SIGHUP（kill -HUP -<进程组>）
     '''
-    # 使用ConfigParser读取ini配置文件
-    cf = ConfigParser.ConfigParser()
-    # 在构造对象之后设置 optionxform 属性为 str 即可区别保留大小写
-    cf.optionxform = str
-    # 获取配置文件路径
-    conf_file = "%s/%s" % (conf_path, conf_file)
-    # cls表示自身类这里也就是config
-    cf.read(conf_file)
-    if conf_name:
-        # 获取数据的项目的数据
-        conf = cf.items(conf_name)
-        return dict(conf)
-    # 获取配置文件中有哪些项目
-    return cf.sections()
+    signal.signal(signal.SIGHUP, registry.sighup)
 
 
 if __name__ == "__main__":
@@ -3,6 +3,8 @@
 '''
 一个简单的对称加密
 支持16位字符串特殊符号key给字符串加密
+每条消息都重新生成 IV 和 cipher 并 base64 编码，加密 xnet 连接上的数据时
+使用 xlib/xnet/netcrypt.py 的连接级加密
 '''
 import os
 import sys
@@ -0,0 +1,201 @@
+# coding=utf-8
+
+"""服务端接收数据的追加写日志
+append 只把数据放进内存队列并唤醒写线程，不做磁盘 IO，可以在 epoll 线程中调用
+写线程把队列中积累的数据一次写入（group commit），每 fsync_interval 秒 fsync 一次，
+需要确认落盘的数据（durable）在覆盖它的 fsync 完成后通知，写入或者 fsync 出错时立即通知失败
+
+日志按大小（segment_size）或者时间（segment_time）分段，文件名中带有进程号，
+多进程（run_workers 或者进程池）时每个进程写自己的分段：
+    ingest-20170101120000-1234-1.log
+服务端写入的每行是一个 json 样本，或者一个二进制编码的批次（见 xnet codec.log_line，
+用 codec.parse_log_line 读取）
+
+    log = IngestLog("./data")
+    log.append(line + "\\n")
+    ticket = log.append(line + "\\n", durable=True)
+    ticket.wait(5)                      # 阻塞等待，或者
+    ticket.add_callback(on_done)        # 落盘或者失败后在写线程中调用 on_done(ticket)
+"""
+import os
+import time
+import logging
+import threading
+
+# 分段文件大小
+SEGMENT_SIZE = 64 * 1024 * 1024
+# 分段文件最长写入时间（秒）
+SEGMENT_TIME = 3600
+# fsync 间隔（秒）
+FSYNC_INTERVAL = 1.0
+# 文件写缓冲
+BUFFER_SIZE = 1024 * 1024
+
+
+class Ticket(object):
+    '''等待落盘的通知，ok 为 True 是已经落盘，为 False 是写入失败'''
+
+    def __init__(self):
+        self.ok = None
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks = []
+
+    def set(self, ok=True):
+        with self.lock:
+            if self.event.is_set():
+                return
+            self.ok = ok
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_callback(self, callback):
+        '''落盘或者失败后调用 callback(ticket)，已经完成时立即调用'''
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def wait(self, timeout=None):
+        '''等待落盘，返回是否已经落盘（超时或者写入失败时返回 False）'''
+        self.event.wait(timeout)
+        return bool(self.ok)
+
+
+class IngestLog(object):
+    '''分段追加写日志，线程安全
+    fsync_interval 为 0 时每次写入后都 fsync
+    '''
+
+    def __init__(self, path, segment_size=SEGMENT_SIZE, segment_time=SEGMENT_TIME,
+                 fsync_interval=FSYNC_INTERVAL, buffer_size=BUFFER_SIZE):
+        self.path = path
+        self.segment_size = segment_size
+        self.segment_time = segment_time
+        self.fsync_interval = fsync_interval
+        self.buffer_size = buffer_size
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.cond = threading.Condition()
+        # 等待写入的数据和等待落盘通知的 ticket
+        self.pending = []
+        self.tickets = []
+        self.closed = False
+        self.file = None
+        self.seq = 0
+        # 当前分段已经写入的字节数和创建时间
+        self.size = 0
+        self.opened = 0
+        # 有没有 fsync 的数据，和已经写入还没有 fsync 的 ticket
+        self.dirty = False
+        self.unsynced = []
+        self.synced = time.time()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(1)
+        self.thread.start()
+
+    def append(self, data, durable=False):
+        '''加入一条数据（调用者负责加换行），不阻塞
+        durable 为真时返回一个 Ticket，数据 fsync 后（或者写入失败时）通知
+        '''
+        ticket = Ticket() if durable else None
+        with self.cond:
+            if self.closed:
+                raise IOError("ingest log closed")
+            self.pending.append(data)
+            if ticket is not None:
+                self.tickets.append(ticket)
+            self.cond.notify()
+        return ticket
+
+    def run(self):
+        '''写线程'''
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    # 有没有落盘的数据时，等到下一次 fsync 的时间
+                    if self.dirty:
+                        wait = self.synced + self.fsync_interval - time.time()
+                        if wait <= 0:
+                            break
+                        self.cond.wait(wait)
+                    else:
+                        self.cond.wait()
+                pending, self.pending = self.pending, []
+                tickets, self.tickets = self.tickets, []
+                closed = self.closed
+            try:
+                if pending:
+                    self.write(pending)
+                self.unsynced.extend(tickets)
+                tickets = []
+                if self.dirty and (closed or time.time() - self.synced >=
+                                   self.fsync_interval):
+                    self.sync()
+            except (IOError, OSError) as msg:
+                # 这次写入和还没有落盘的数据都不能确认，立即通知失败（客户端会重发），
+                # 不再使用出错的分段，下次写入时创建新的分段
+                logging.error("***ingest log: write error(%s)***" % msg)
+                unsynced, self.unsynced = self.unsynced, []
+                for ticket in unsynced + tickets:
+                    ticket.set(False)
+                self.discard()
+            if closed:
+                if self.file is not None:
+                    self.file.close()
+                return
+
+    def write(self, pending):
+        '''一次写入积累的数据，需要时切换分段'''
+        now = time.time()
+        if self.file is None or self.size >= self.segment_size or \
+                now - self.opened >= self.segment_time:
+            self.rotate(now)
+        data = "".join(pending)
+        self.file.write(data)
+        self.size += len(data)
+        self.dirty = True
+
+    def discard(self):
+        '''关闭出错的分段'''
+        if self.file is not None:
+            try:
+                self.file.close()
+            except (IOError, OSError):
+                pass
+        self.file = None
+        self.dirty = False
+
+    def rotate(self, now):
+        '''关闭当前分段（先落盘），创建新的分段'''
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+        self.seq += 1
+        name = "ingest-%s-%d-%d.log" % (
+            time.strftime("%Y%m%d%H%M%S", time.localtime(now)), os.getpid(),
+            self.seq)
+        self.file = open(os.path.join(self.path, name), "ab", self.buffer_size)
+        self.size = 0
+        self.opened = now
+
+    def sync(self):
+        '''fsync 并通知等待落盘的 ticket'''
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.dirty = False
+        self.synced = time.time()
+        unsynced, self.unsynced = self.unsynced, []
+        for ticket in unsynced:
+            ticket.set()
+
+    def close(self):
+        '''写入所有数据并落盘后关闭'''
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
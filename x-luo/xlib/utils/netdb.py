@@ -1,43 +1,327 @@
 #!/usr/bin/env python
 # coding=utf-8
 
-import MySQLdb as mysql
+import re
+import time
+import zlib
+import logging
+import sqlite3
+import threading
+import collections
+
+try:
+    import MySQLdb as mysql
+except ImportError:
+    mysql = None
 from config import config
 
-db_conf = config('xnet', 'db')
+# engine=mysql 时使用 host/port/user/passwd/db/charset，
+# engine=sqlite 时使用 path（测试用）
+# pool_size/max_lifetime/ping_interval 是连接池的配置
+# shard_count/shard_prefix 是按主机名分表的配置
+# select_cache/select_cache_ttl 是 db.select 结果缓存的配置
+db_conf = config('./conf', 'db', 'db')
+
+
+def connect_mysql():
+    '''按配置文件创建 mysql 连接'''
+    conn = mysql.connect(
+        host=db_conf['host'],
+        port=int(db_conf['port']),
+        user=db_conf['user'],
+        passwd=db_conf['passwd'],
+        db=db_conf['db'],
+        charset=db_conf['charset']
+    )
+    conn.autocommit(True)
+    return conn
+
+
+def connect_sqlite(path=":memory:"):
+    '''sqlite 连接（测试时代替 mysql），自动提交，可以在多个线程中使用
+    sql 中的 %s 参数占位符会转换成 sqlite 的 ?
+    '''
+    return SqliteConnection(path)
+
+
+class SqliteConnection(object):
+    '''让 sqlite 连接和 MySQLdb 的连接用法相同'''
+    OperationalError = sqlite3.OperationalError
+    InterfaceError = sqlite3.InterfaceError
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False,
+                                    isolation_level=None)
+
+    def cursor(self):
+        return SqliteCursor(self.conn.cursor())
+
+    def ping(self):
+        self.conn.execute("select 1")
+
+    def close(self):
+        self.conn.close()
+
+
+class SqliteCursor(object):
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, sql, param=None):
+        sql = sql.replace("%s", "?")
+        if param is None:
+            self.cursor.execute(sql)
+        else:
+            self.cursor.execute(sql, param)
+        return self.cursor.rowcount
+
+    def executemany(self, sql, params):
+        # 自动提交模式下每行是一个事务，批量写入放在一个事务中（和 mysql 的多行 INSERT 一样）
+        self.cursor.execute("BEGIN")
+        try:
+            self.cursor.executemany(sql.replace("%s", "?"), params)
+            result = self.cursor.rowcount
+        except BaseException:
+            self.cursor.execute("ROLLBACK")
+            raise
+        self.cursor.execute("COMMIT")
+        return result
+
+    def fetchall(self):
+        return tuple(self.cursor.fetchall())
+
+    def close(self):
+        self.cursor.close()
+
+
+class ConnectionPool(object):
+    '''线程安全的连接池
+    connect: 创建连接的函数
+    size: 最多同时打开的连接数，连接都在使用中时 get 等待 timeout 秒
+    max_lifetime: 连接创建超过这个时间（秒）后不再使用，关闭后重新创建
+    ping_interval: 连接空闲超过这个时间（秒）后，取出时先 ping 检查
+    '''
+
+    def __init__(self, connect, size=8, max_lifetime=3600, ping_interval=30,
+                 timeout=10):
+        self.connect = connect
+        self.size = size
+        self.max_lifetime = max_lifetime
+        self.ping_interval = ping_interval
+        self.timeout = timeout
+        self.cond = threading.Condition()
+        # 空闲的连接 [(连接, 创建时间, 放回时间)]，后放回的先取出
+        self.idle = []
+        # 已经创建还没有关闭的连接数
+        self.opened = 0
+        # 连接 -> 创建时间
+        self.created = {}
+
+    def get(self):
+        '''取出一个可用的连接'''
+        deadline = time.time() + self.timeout
+        while True:
+            with self.cond:
+                while not self.idle and self.opened >= self.size:
+                    left = deadline - time.time()
+                    if left <= 0:
+                        raise RuntimeError("db pool timeout")
+                    self.cond.wait(left)
+                if self.idle:
+                    conn, created, released = self.idle.pop()
+                else:
+                    conn = None
+                    self.opened += 1
+            if conn is None:
+                try:
+                    conn = self.connect()
+                except BaseException:
+                    self.discard()
+                    raise
+                self.created[id(conn)] = time.time()
+                return conn
+            now = time.time()
+            if now - created >= self.max_lifetime:
+                self.discard(conn)
+                continue
+            if now - released >= self.ping_interval:
+                try:
+                    conn.ping()
+                except Exception as msg:
+                    logging.info("***db pool: ping error(%s)***" % msg)
+                    self.discard(conn)
+                    continue
+            return conn
+
+    def put(self, conn):
+        '''用完的连接放回连接池'''
+        with self.cond:
+            self.idle.append((conn, self.created[id(conn)], time.time()))
+            self.cond.notify()
+
+    def discard(self, conn=None):
+        '''关闭出错或者过期的连接'''
+        if conn is not None:
+            self.created.pop(id(conn), None)
+            try:
+                conn.close()
+            except Exception:
+                pass
+        with self.cond:
+            self.opened -= 1
+            self.cond.notify()
+
+    def close(self):
+        '''关闭所有空闲的连接'''
+        with self.cond:
+            idle, self.idle = self.idle, []
+        for conn, created, released in idle:
+            self.discard(conn)
+
+
+# 默认的连接池，第一次使用时创建
+pool = None
+pool_lock = threading.Lock()
+
+
+def get_pool():
+    global pool
+    if pool is None:
+        with pool_lock:
+            if pool is None:
+                if db_conf.get('engine', 'mysql') == 'sqlite':
+                    connect = lambda: connect_sqlite(db_conf['path'])
+                else:
+                    connect = connect_mysql
+                pool = ConnectionPool(
+                    connect,
+                    int(db_conf.get('pool_size', 8)),
+                    int(db_conf.get('max_lifetime', 3600)),
+                    int(db_conf.get('ping_interval', 30)))
+    return pool
+
+
+def connection_errors(conn):
+    '''连接的 DB-API 连接错误类型（MySQLdb 和 sqlite 的连接对象上都有）'''
+    return tuple(getattr(conn, name) for name in
+                 ("OperationalError", "InterfaceError") if hasattr(conn, name))
 
 
 class LinkMysql(object):
     '''简单对mysqldb进行上下文封装
-    操作完成后自动关闭连接
+    从连接池中取出连接，操作完成后放回连接池，
+    出现连接错误时关闭这个连接
     '''
 
-    def __init__(self):
-        self.conn = mysql.connect(
-            host=db_conf['host'],
-            port=int(db_conf['port']),
-            user=db_conf['user'],
-            passwd=db_conf['passwd'],
-            db=db_conf['db'],
-            charset=db_conf['charset']
-        )
-
-        self.conn.autocommit(True)
+    def __init__(self, db_pool=None):
+        self.pool = db_pool or get_pool()
+        self.conn = self.pool.get()
         self.cursor = self.conn.cursor()
 
     def __enter__(self):
         return self.cursor
 
     def __exit__(self, exc_type, exc_value, traceback):
-        # 关闭连接
         self.cursor.close()
-        self.conn.close()
+        # 连接错误时关闭连接，其他错误（比如 sql 错误）连接仍然可以使用
+        if exc_type and issubclass(exc_type, connection_errors(self.conn)):
+            self.pool.discard(self.conn)
+        else:
+            self.pool.put(self.conn)
         # 如果使用过程发现了异常返回假，这样系统就会重新抛出异常
         if exc_type:
             return False
         return True
 
 
+# sql 中读写的表名
+TABLE_RE = re.compile(r"\b(?:from|join|into|update|table)\s+`?(\w+)`?", re.I)
+
+
+def sql_tables(sql):
+    return frozenset(name.lower() for name in TABLE_RE.findall(sql))
+
+
+class SelectCache(object):
+    '''db.select 的结果缓存，按 (sql, 参数) 保存，最多 size 条（LRU），ttl 秒后过期
+    db.execute/executemany 写入一张表时，读这张表的缓存失效，
+    其他进程或者其他程序的写入只能等 ttl 过期
+    '''
+
+    def __init__(self, size=1024, ttl=10):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # (sql, 参数) -> (过期时间, 表名集合, 表的写入次数, 结果)，按最近使用排列
+        self.data = collections.OrderedDict()
+        # 表名 -> 写入次数，查询期间有写入时结果不放入缓存，
+        # 缓存之后有写入时读取时失效（写入时不扫描缓存）
+        self.generation = {}
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, sql, param):
+        '''缓存的键，参数不能 hash（比如字典）时返回 None 不缓存'''
+        if isinstance(param, list):
+            param = tuple(param)
+        key = (sql, param)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def get(self, key):
+        '''返回缓存的结果，没有、已经过期或者缓存后表有写入时返回 None'''
+        with self.lock:
+            item = self.data.pop(key, None)
+            if item is None or item[0] <= time.time() or \
+                    self._version(item[1]) != item[2]:
+                self.misses += 1
+                return None
+            self.data[key] = item
+            self.hits += 1
+            return item[3]
+
+    def version(self, tables):
+        with self.lock:
+            return self._version(tables)
+
+    def _version(self, tables):
+        return tuple(self.generation.get(table, 0) for table in tables)
+
+    def put(self, key, tables, version, result):
+        '''保存查询结果，version 是查询前的 self.version(tables)'''
+        with self.lock:
+            if self._version(tables) != version:
+                return
+            self.data.pop(key, None)
+            self.data[key] = (time.time() + self.ttl, tables, version, result)
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+
+    def invalidate(self, sql):
+        '''sql 写入的表的缓存失效，只增加表的写入次数，O(表数)
+        失效的缓存在读取时丢弃，或者按最近使用被挤出
+        '''
+        with self.lock:
+            for table in sql_tables(sql):
+                self.generation[table] = self.generation.get(table, 0) + 1
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        return {"size": len(self.data), "hits": self.hits, "misses": self.misses}
+
+
+# select_cache 为 0 时不缓存（默认）
+cache = SelectCache(int(db_conf.get('select_cache', 0)),
+                    float(db_conf.get('select_cache_ttl', 10))) \
+    if int(db_conf.get('select_cache', 0)) else None
+
+
 class db(object):
     '''定义了一些简单的操作方法
     restult 返回的是执行结果，比如添加了1条数据返回的就是1
@@ -46,17 +330,225 @@ class db(object):
     @staticmethod
     def execute(sql, param=None):
         '''返回执行结果'''
-        with LinkMysql() as db:
-            result = db.execute(sql, param)
+        try:
+            with LinkMysql() as db:
+                result = db.execute(sql, param)
+        finally:
+            if cache is not None:
+                cache.invalidate(sql)
         return result
 
     @staticmethod
-    def select(sql, param=None):
-        '''返回元组，0是结果，1是数据'''
+    def executemany(sql, params):
+        '''批量执行，返回执行结果'''
+        try:
+            with LinkMysql() as db:
+                result = db.executemany(sql, params)
+        finally:
+            if cache is not None:
+                cache.invalidate(sql)
+        return result
+
+    @staticmethod
+    def select(sql, param=None, use_cache=True):
+        '''返回元组，0是结果，1是数据
+        配置了 select_cache 时使用结果缓存，use_cache 为假时直接查询
+        '''
+        key = cache.key(sql, param) if use_cache and cache is not None else None
+        if key is not None:
+            result = cache.get(key)
+            if result is not None:
+                return result
+            tables = sql_tables(sql)
+            version = cache.version(tables)
         with LinkMysql() as db:
-            result = db.execute(sql, param)
+            db.execute(sql, param)
             data = db.fetchall()
-        return result, data
+        if key is not None:
+            cache.put(key, tables, version, (len(data), data))
+        return len(data), data
+
+
+class BatchWriter(object):
+    '''批量写入
+    add 只把数据行放进缓存，积累到 batch_size 行或者距离上次写入超过 interval 秒时，
+    由后台线程使用 executemany 一次写入（MySQLdb 会把 INSERT 改写成多行 INSERT）
+    写入失败时数据留在缓存中下次重试，缓存超过 max_pending 行时丢弃最老的数据
+
+        writer = BatchWriter("stat_0", ["host", "mem_free", "time"])
+        writer.add(("incloud_ma_sd", 6711, 1435385887))
+    '''
+
+    def __init__(self, table, columns, batch_size=500, interval=1.0,
+                 max_pending=100000, execute=None):
+        self.sql = "INSERT INTO `%s` (%s) VALUES (%s)" % (
+            table, ",".join("`%s`" % column for column in columns),
+            ",".join(["%s"] * len(columns)))
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_pending = max_pending
+        self.execute = execute or db.executemany
+        self.cond = threading.Condition()
+        self.rows = []
+        self.closed = False
+        # 已经写入和丢弃的行数
+        self.written = 0
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(1)
+        self.thread.start()
+
+    def add(self, row):
+        '''加入一行，不阻塞'''
+        with self.cond:
+            self.rows.append(row)
+            self.trim()
+            if len(self.rows) >= self.batch_size:
+                self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                deadline = time.time() + self.interval
+                while len(self.rows) < self.batch_size and not self.closed:
+                    left = deadline - time.time()
+                    if left <= 0:
+                        break
+                    self.cond.wait(left)
+                rows = self.rows[:self.batch_size]
+                del self.rows[:self.batch_size]
+                closed = self.closed
+            if rows and not self.flush(rows):
+                if closed:
+                    return
+                # 写入失败，等一个间隔再重试
+                time.sleep(self.interval)
+            elif closed and not self.rows:
+                return
+
+    def flush(self, rows):
+        '''写入一批，失败时放回缓存的开头'''
+        try:
+            self.execute(self.sql, rows)
+        except Exception as msg:
+            logging.error("***batch writer: %s error(%s)***" % (self.sql, msg))
+            with self.cond:
+                self.rows[:0] = rows
+                self.trim()
+            return False
+        self.written += len(rows)
+        return True
+
+    def trim(self):
+        '''缓存超过 max_pending 行时丢弃最老的数据'''
+        if len(self.rows) > self.max_pending:
+            drop = len(self.rows) - self.max_pending
+            del self.rows[:drop]
+            self.dropped += drop
+            logging.error("***batch writer: drop %d rows***" % drop)
+
+    def close(self):
+        '''写入剩余的数据后结束'''
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+
+
+def shard_table(host, count, prefix="stat"):
+    '''主机名对应的分表名，使用 crc32（不随进程和版本变化）
+    json 解析出的主机名是 unicode，按 utf-8 编码后计算
+    '''
+    if isinstance(host, unicode):
+        host = host.encode("utf-8")
+    return "%s_%d" % (prefix, (zlib.crc32(host) & 0xffffffff) % count)
+
+
+class Shards(object):
+    '''按主机名把数据分到 count 张表 prefix_0 ... prefix_{count-1}
+    写入时每张分表一个 BatchWriter（各自的写线程并行写入），
+    查询时在所有（或者相关主机的）分表上并行执行再合并结果
+
+        shards = Shards(["host", "mem_free", "time"])
+        shards.add(("incloud_ma_sd", 6711, 1435385887))
+        shards.select("select * from {table} where host=%s", ("incloud_ma_sd",),
+                      hosts=["incloud_ma_sd"])
+
+    分表数改变后主机会对应到其他分表，需要先迁移数据
+    '''
+
+    def __init__(self, columns, count=None, prefix=None, host_column="host",
+                 **writer_args):
+        self.columns = columns
+        self.count = int(count or db_conf.get('shard_count', 4))
+        self.prefix = prefix or db_conf.get('shard_prefix', 'stat')
+        self.host_index = list(columns).index(host_column)
+        self.writer_args = writer_args
+        self.writers = {}
+        self.lock = threading.Lock()
+
+    def tables(self, hosts=None):
+        '''所有分表，或者 hosts 所在的分表'''
+        if hosts is None:
+            return ["%s_%d" % (self.prefix, i) for i in range(self.count)]
+        return sorted(set(self.table(host) for host in hosts))
+
+    def table(self, host):
+        return shard_table(host, self.count, self.prefix)
+
+    def writer(self, table):
+        '''分表的 BatchWriter，第一次写入时创建'''
+        writer = self.writers.get(table)
+        if writer is None:
+            with self.lock:
+                writer = self.writers.get(table)
+                if writer is None:
+                    writer = self.writers[table] = BatchWriter(
+                        table, self.columns, **self.writer_args)
+        return writer
+
+    def add(self, row):
+        '''按行中的主机名写入对应的分表，不阻塞'''
+        self.writer(self.table(row[self.host_index])).add(row)
+
+    def select(self, sql, param=None, hosts=None):
+        '''在分表上并行查询，sql 中的 {table} 替换成分表名
+        hosts 为 None 时查询所有分表，返回值和 db.select 相同
+        '''
+        tables = self.tables(hosts)
+        results = scatter([sql.replace("{table}", table) for table in tables],
+                          param)
+        data = tuple(row for result in results for row in result)
+        return len(data), data
+
+    def close(self):
+        '''写入所有分表剩余的数据'''
+        for writer in self.writers.values():
+            writer.close()
+
+
+def scatter(sqls, param=None):
+    '''每条 sql 在一个线程中查询（各自从连接池取连接），按 sqls 的顺序返回数据
+    任何一条出错时抛出第一个异常
+    '''
+    results = [None] * len(sqls)
+    errors = []
+
+    def run(i, sql):
+        try:
+            results[i] = db.select(sql, param)[1]
+        except Exception as msg:
+            errors.append(msg)
+
+    threads = [threading.Thread(target=run, args=(i, sql))
+               for i, sql in enumerate(sqls)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
 
 
 if __name__ == '__main__':
@@ -0,0 +1,235 @@
+# coding=utf-8
+
+"""本地磁盘缓存（spool）
+agent 采集的数据先追加写入磁盘，发送成功后再提交读取位置，
+服务端维护或者网络中断期间数据留在磁盘上，恢复后按顺序分批重发
+
+目录中是按编号递增的分段文件（00000001.spool ...），每行一条记录，只追加不修改，
+写满 segment_size 后换下一个文件，所有分段超过 max_bytes 时删除最老的分段
+（磁盘占用有上限，只有超过上限时才会丢弃最老的数据）
+
+读取位置（分段编号 + 文件偏移）保存在 offset 文件中，先写临时文件再 rename，
+进程任何时候崩溃都只会留下旧的或者新的位置；在发送成功和提交位置之间崩溃时
+这一批数据会重发一次（至少一次）
+
+    spool = Spool("./spool")
+    spool.append(json.dumps(data))
+    lines, cursor = spool.read(100, 64 * 1024)
+    if send(lines):
+        spool.commit(cursor)
+"""
+import os
+import logging
+import threading
+
+# 分段文件的大小
+SEGMENT_SIZE = 4 * 1024 * 1024
+# 所有分段的总大小上限
+MAX_BYTES = 256 * 1024 * 1024
+SUFFIX = ".spool"
+# 服务端拒绝的记录保存在这个文件中（不再重发）
+REJECTED = "rejected"
+
+
+class Spool(object):
+    '''分段的追加写文件队列，线程安全（采集线程写，发送线程读）
+    path: 目录，不存在时创建
+    fsync: 每次写入是否 fsync，关闭时只保证进程崩溃不丢数据，机器掉电可能丢失
+    '''
+
+    def __init__(self, path, segment_size=SEGMENT_SIZE, max_bytes=MAX_BYTES,
+                 fsync=True):
+        self.path = path
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        # 写入新数据时唤醒等待的发送线程
+        self.cond = threading.Condition(self.lock)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        # 分段编号 -> 文件大小
+        self.segments = {}
+        for name in os.listdir(path):
+            if name.endswith(SUFFIX) and name[:-len(SUFFIX)].isdigit():
+                seq = int(name[:-len(SUFFIX)])
+                self.segments[seq] = os.path.getsize(self.segment(seq))
+        # 读取位置 (分段编号, 偏移)
+        self.cursor = self.load_offset()
+        for seq in sorted(self.segments):
+            if seq < self.cursor[0]:
+                self.remove(seq)
+        if not self.segments:
+            self.segments[max(self.cursor[0], 1)] = 0
+        if self.cursor[0] not in self.segments:
+            self.cursor = (min(self.segments), 0)
+        self.wseq = max(self.segments)
+        self.repair(self.wseq)
+        if self.cursor[1] > self.segments[self.cursor[0]]:
+            self.cursor = (self.cursor[0], self.segments[self.cursor[0]])
+        self.wfile = open(self.segment(self.wseq), "ab")
+        self.rfile = None
+        self.rseq = None
+
+    def segment(self, seq):
+        '''分段文件的路径'''
+        return os.path.join(self.path, "%08d%s" % (seq, SUFFIX))
+
+    def load_offset(self):
+        '''读取保存的读取位置，没有时从头开始'''
+        try:
+            with open(os.path.join(self.path, "offset")) as f:
+                seq, pos = f.read().split()
+                return int(seq), int(pos)
+        except (IOError, ValueError):
+            return 0, 0
+
+    def save_offset(self):
+        '''原子地保存读取位置'''
+        offset = os.path.join(self.path, "offset")
+        with open(offset + ".tmp", "w") as f:
+            f.write("%d %d\n" % self.cursor)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.rename(offset + ".tmp", offset)
+
+    def repair(self, seq):
+        '''去掉最后一个分段末尾写了一半的记录（写入时进程崩溃）'''
+        size = self.segments[seq]
+        if not size:
+            return
+        with open(self.segment(seq), "rb+") as f:
+            data = f.read()
+            if data.endswith("\n"):
+                return
+            cut = data.rfind("\n") + 1
+            logging.warning("***spool: truncate %s from %d to %d***" %
+                            (self.segment(seq), size, cut))
+            f.truncate(cut)
+            self.segments[seq] = cut
+
+    def remove(self, seq):
+        '''删除分段文件'''
+        self.segments.pop(seq, None)
+        if self.rseq == seq:
+            self.rfile.close()
+            self.rfile = self.rseq = None
+        try:
+            os.remove(self.segment(seq))
+        except OSError:
+            pass
+
+    def __len__(self):
+        '''还没有提交的字节数'''
+        with self.lock:
+            return sum(self.segments.values()) - self.cursor[1]
+
+    def _empty(self):
+        return self.cursor == (self.wseq, self.segments[self.wseq])
+
+    def empty(self):
+        with self.lock:
+            return self._empty()
+
+    def wait(self, timeout):
+        '''阻塞等待直到有未读取的数据或者超时，返回是否有数据'''
+        with self.lock:
+            if self._empty():
+                self.cond.wait(timeout)
+            return not self._empty()
+
+    def append(self, line):
+        '''追加一条记录（不能包含换行）'''
+        with self.lock:
+            if self.segments[self.wseq] >= self.segment_size:
+                self.rotate()
+            self.wfile.write(line + "\n")
+            self.wfile.flush()
+            if self.fsync:
+                os.fsync(self.wfile.fileno())
+            self.segments[self.wseq] += len(line) + 1
+            self.trim()
+            self.cond.notify_all()
+
+    def rotate(self):
+        '''换一个新的分段写入'''
+        self.wfile.close()
+        self.wseq += 1
+        self.segments[self.wseq] = 0
+        self.wfile = open(self.segment(self.wseq), "ab")
+
+    def trim(self):
+        '''超过磁盘上限时删除最老的分段，正在写的分段不删除'''
+        dropped = 0
+        while sum(self.segments.values()) > self.max_bytes \
+                and len(self.segments) > 1:
+            seq = min(self.segments)
+            dropped += self.segments[seq]
+            self.remove(seq)
+            if self.cursor[0] <= seq:
+                self.cursor = (min(self.segments), 0)
+                self.save_offset()
+        if dropped:
+            logging.warning("***spool: disk limit %d reached, drop %d bytes***" %
+                            (self.max_bytes, dropped))
+
+    def read(self, count, size):
+        '''从读取位置开始读出最多 count 条、总共不超过 size 字节的记录，不移动读取位置
+        第一条记录即使超过 size 也会读出
+        返回 (记录列表, 读完这些记录后的位置)，发送成功后用这个位置调用 commit
+        '''
+        with self.lock:
+            lines = []
+            seq, pos = self.cursor
+            while len(lines) < count:
+                if pos >= self.segments[seq]:
+                    if seq == self.wseq:
+                        break
+                    seq, pos = min(s for s in self.segments if s > seq), 0
+                    continue
+                if self.rseq != seq:
+                    if self.rfile is not None:
+                        self.rfile.close()
+                    self.rfile = open(self.segment(seq), "rb")
+                    self.rseq = seq
+                self.rfile.seek(pos)
+                line = self.rfile.readline()
+                if not line.endswith("\n") or lines and len(line) > size:
+                    break
+                lines.append(line[:-1])
+                pos += len(line)
+                size -= len(line)
+            return lines, (seq, pos)
+
+    def commit(self, cursor):
+        '''提交读取位置，删除已经读完的分段'''
+        with self.lock:
+            if cursor <= self.cursor or cursor[0] not in self.segments:
+                # 读出后分段已经因为超过磁盘上限被删除
+                return
+            self.cursor = cursor
+            self.save_offset()
+            for seq in sorted(self.segments):
+                if seq >= cursor[0]:
+                    break
+                self.remove(seq)
+
+    def reject(self, lines, cursor):
+        '''服务端永久拒绝的一批记录：追加到 rejected 文件中隔离，再提交读取位置，
+        不再重发，后面的数据可以继续发送
+        '''
+        with self.lock:
+            with open(os.path.join(self.path, REJECTED), "ab") as f:
+                for line in lines:
+                    f.write(line + "\n")
+        logging.error("***spool: %d records rejected, moved to %s***" %
+                      (len(lines), os.path.join(self.path, REJECTED)))
+        self.commit(cursor)
+
+    def close(self):
+        with self.lock:
+            self.wfile.close()
+            if self.rfile is not None:
+                self.rfile.close()
+                self.rfile = self.rseq = None
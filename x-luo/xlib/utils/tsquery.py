@@ -0,0 +1,145 @@
+# coding=utf-8
+
+"""内存时序数据的查询
+查询和返回都是 json，通过 xnet v2 协议的 MSG_QUERY 帧发送：
+
+    {"op": "latest", "metric": "CPU", "hosts": ["h1", "h2"]}
+    {"op": "range", "metric": "CPU", "host": "h1", "start": 1500000000, "end": 1500000300}
+    {"op": "avg", "metric": "CPU", "window": 300}
+    {"op": "percentile", "q": 95, "metric": "CPU", "hosts": ["h1"], "window": 300}
+
+op: latest 最新的点，range 时间范围内的点，min/max/avg/percentile 时间范围内的聚合
+hosts/host: 查询的主机（hosts 是列表，也可以是一个主机名），都没有时查询所有有这个监控项的主机
+start/end: 时间范围（秒），或者使用 window 表示最近 window 秒
+
+返回 {"ok": true, "result": {"h1": 结果, ...}, "partial": false}，没有数据的主机结果为 null
+出错时返回 {"ok": false, "error": "错误信息"}
+服务端是多进程时（reuseport=1 或者 pool=process）每个进程只有自己收到的数据，
+partial 为 true，其他进程中的主机结果也是 null
+
+查询结果按 (查询, 时间范围) 缓存，涉及的序列有新数据时缓存失效
+window 查询按 window 的长度缓存，window_step 秒内重复的查询直接返回缓存的结果
+（结果最多晚 window_step 秒），超过后序列没有变化并且结束时间相同时才使用缓存
+"""
+import json
+import math
+import time
+import collections
+
+OPS = ("latest", "range", "min", "max", "avg", "percentile")
+# 缓存的查询结果数
+CACHE_SIZE = 1024
+# window 查询的结果缓存多长时间（秒）
+WINDOW_STEP = 5
+
+
+class QueryEngine(object):
+    '''在 Store 上执行查询，可以直接作为 MSG_QUERY 的处理函数
+    engine = QueryEngine(store)
+    XNet(sock, logic, handlers={MSG_QUERY: engine})
+    '''
+
+    def __init__(self, store, cache_size=CACHE_SIZE, window_step=WINDOW_STEP,
+                 partial=False):
+        self.store = store
+        self.cache_size = cache_size
+        self.window_step = window_step
+        # store 只有一部分数据（多进程的服务端）时为真，返回中带上 partial
+        self.partial = partial
+        # 查询 -> (序列版本, 结束时间, 结果)，按最近使用排列
+        self.cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, data):
+        try:
+            result = self.execute(json.loads(data))
+        except (ValueError, KeyError, TypeError) as msg:
+            return json.dumps({"ok": False, "error": str(msg)})
+        return json.dumps({"ok": True, "result": result,
+                           "partial": self.partial})
+
+    def execute(self, query, now=None):
+        '''执行一个查询（字典），返回 {主机: 结果}'''
+        op = query.get("op")
+        if op not in OPS:
+            raise ValueError("unknown op %r" % op)
+        metric = query["metric"]
+        start, end = time_range(query, now)
+        q = None
+        if op == "percentile":
+            q = float(query["q"])
+            if not 0 < q <= 100:
+                raise ValueError("percentile q must be in (0, 100]")
+        if "hosts" in query:
+            hosts = query["hosts"]
+            # 一个主机名的字符串不能按字符展开
+            hosts = [hosts] if isinstance(hosts, basestring) else list(hosts)
+        elif "host" in query:
+            hosts = [query["host"]]
+        else:
+            hosts = self.store.hosts(metric)
+        if "window" in query:
+            # 结束时间每秒都在变，按 window 的长度缓存，用缓存的结束时间判断是否过期
+            key = (op, metric, tuple(hosts), ("window", end - start), q)
+        else:
+            key = (op, metric, tuple(hosts), start, end, q)
+        # 查询过程中不能有写入，在锁中直接读取正在写入的序列，不复制
+        with self.store.lock:
+            cached = self.cache.pop(key, None)
+            if cached is not None and end is not None and \
+                    0 <= end - cached[1] < self.window_step and "window" in query:
+                self.hits += 1
+                self.cache[key] = cached
+                return cached[2]
+            series_l = [self.store.live_series(host, metric) for host in hosts]
+            versions = tuple(series.version if series is not None else -1
+                             for series in series_l)
+            if cached is not None and cached[0] == versions and \
+                    cached[1] == end:
+                self.hits += 1
+                self.cache[key] = cached
+                return cached[2]
+            self.misses += 1
+            result = dict((host, compute(op, series, start, end, q))
+                          for host, series in zip(hosts, series_l))
+            self.cache[key] = (versions, end, result)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+            return result
+
+
+def time_range(query, now=None):
+    '''查询的时间范围 (start, end)，没有限制的一端是 None'''
+    if "window" in query:
+        end = int(now or time.time())
+        return end - int(query["window"]), end
+    start = query.get("start")
+    end = query.get("end")
+    return (None if start is None else int(start),
+            None if end is None else int(end))
+
+
+def compute(op, series, start, end, q=None):
+    '''在一个序列上计算查询结果，没有数据时返回 None'''
+    if series is None:
+        return None
+    if op == "latest":
+        latest = series.latest()
+        return list(latest) if latest is not None else None
+    points = series.range(start, end)
+    if op == "range":
+        return [list(point) for point in points]
+    if not points:
+        return None
+    values = [value for ts, value in points]
+    if op == "min":
+        return min(values)
+    if op == "max":
+        return max(values)
+    if op == "avg":
+        return sum(values) / len(values)
+    # 最近秩（nearest-rank）百分位
+    values.sort()
+    rank = int(math.ceil(q / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
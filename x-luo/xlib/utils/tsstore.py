@@ -0,0 +1,275 @@
+# coding=utf-8
+
+"""内存时序数据
+按 (主机名, 监控项) 保存最近的数据点，每个序列是固定大小的环形缓存区，
+时间和数值分别保存在 array 中（默认时间 4 字节整数秒，数值 4 字节浮点数），
+一个序列占用的内存是固定的：capacity * 8 字节
+
+超过 capacity 个点时覆盖最老的点，早于 retention 秒的点在写入和查询时丢弃
+同一个序列的点按时间顺序写入，比最新的点还早的点会被丢弃
+
+    store = Store(capacity=1200, retention=3600)
+    store.add({"hostname": "meetbill", "CPU": 12})
+    store.series("meetbill", "CPU").latest()
+"""
+import time
+import array
+import threading
+
+# 每个序列保存的点数
+CAPACITY = 1200
+# 保留时间（秒）
+RETENTION = 3600
+# 写入时检查所有序列过期数据的间隔（秒）
+EXPIRE_INTERVAL = 60
+# 数据中不作为监控项的字段
+SKIP_KEYS = ("hostname", "time")
+# 时间是 4 字节无符号整数秒，不能超过这个值（毫秒时间戳也会超过）
+TIME_MAX = 2 ** 32
+
+
+class Series(object):
+    '''一个序列的环形缓存区
+    head 是最老的点的位置，count 是点数
+    '''
+
+    def __init__(self, capacity=CAPACITY, time_type="I", value_type="f"):
+        self.capacity = capacity
+        self.times = array.array(time_type, [0]) * capacity
+        self.values = array.array(value_type, [0]) * capacity
+        self.head = 0
+        self.count = 0
+        # 每次写入或者丢弃数据时加 1，用于判断查询缓存是否失效
+        self.version = 0
+
+    def __len__(self):
+        return self.count
+
+    def _pos(self, i):
+        '''第 i 个点（从最老的开始）在缓存区中的位置'''
+        return (self.head + i) % self.capacity
+
+    def time_at(self, i):
+        return self.times[self._pos(i)]
+
+    def append(self, ts, value):
+        '''写入一个点，比最新的点早时丢弃并返回 False'''
+        ts = int(ts)
+        if self.count and ts < self.times[self._pos(self.count - 1)]:
+            return False
+        if self.count < self.capacity:
+            pos = self._pos(self.count)
+            self.count += 1
+        else:
+            # 已满，覆盖最老的点
+            pos = self.head
+            self.head = (self.head + 1) % self.capacity
+        self.times[pos] = ts
+        self.values[pos] = value
+        self.version += 1
+        return True
+
+    def expire(self, before):
+        '''丢弃时间早于 before 的点'''
+        drop = self.bisect(before)
+        if drop:
+            self.head = self._pos(drop)
+            self.count -= drop
+            self.version += 1
+        return drop
+
+    def bisect(self, ts):
+        '''第一个时间不早于 ts 的点的序号'''
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.time_at(mid) < ts:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def latest(self):
+        '''最新的点 (时间, 数值)，没有数据时返回 None'''
+        if not self.count:
+            return None
+        pos = self._pos(self.count - 1)
+        return self.times[pos], self.values[pos]
+
+    def range(self, start=None, end=None):
+        '''时间在 [start, end] 中的点的列表 [(时间, 数值), ...]'''
+        first = 0 if start is None else self.bisect(start)
+        last = self.count if end is None else self.bisect(end + 1)
+        return [(self.times[pos], self.values[pos])
+                for pos in (self._pos(i) for i in range(first, last))]
+
+    def nbytes(self):
+        return self.times.itemsize * len(self.times) + \
+            self.values.itemsize * len(self.values)
+
+    def copy(self):
+        '''快照（复制两个 array），之后的写入不影响快照'''
+        snap = Series.__new__(Series)
+        snap.capacity = self.capacity
+        snap.times = self.times[:]
+        snap.values = self.values[:]
+        snap.head = self.head
+        snap.count = self.count
+        snap.version = self.version
+        return snap
+
+
+class Store(object):
+    '''(主机名, 监控项) -> Series，线程安全
+    value_type 是数值的 array 类型，"f"（4 字节）的精度约 7 位有效数字，
+    需要更高精度时使用 "d"（8 字节）
+    '''
+
+    def __init__(self, capacity=CAPACITY, retention=RETENTION, value_type="f"):
+        self.capacity = capacity
+        self.retention = retention
+        self.value_type = value_type
+        self.data = {}
+        # 监控项 -> 有这个监控项的主机集合
+        self.index = {}
+        # 查询时在锁中调用 live_series、hosts 等方法，所以使用 RLock
+        self.lock = threading.RLock()
+        # 因为时间早于最新的点被丢弃的点数
+        self.dropped = 0
+        self.expired = time.time()
+
+    def __len__(self):
+        return len(self.data)
+
+    def add(self, sample, now=None):
+        '''写入一个采集数据（字典），hostname 是主机名，time 是采集时间（没有时使用 now），
+        其他数字字段是监控项，嵌套的字典按 "key.subkey" 展开
+        sample 也可以是二进制编码的样本（xnet codec.Record），直接取出展开的监控项
+        数据不能写入时抛出 ValueError（见 prepare）
+        '''
+        now = now or time.time()
+        return self.insert(self.prepare(sample, now), now)
+
+    def prepare(self, sample, now=None):
+        '''检查一个采集数据，返回 (主机名, 时间, [(监控项, 数值), ...])，没有主机名时返回 None
+        主机名不是字符串、时间超出范围或者数值太大时抛出 ValueError，
+        批量写入时先检查所有数据，都正确后再 insert
+        '''
+        host = sample.get("hostname")
+        if host is None:
+            return None
+        if not isinstance(host, basestring):
+            raise ValueError("bad hostname %r" % (host,))
+        ts = sample.get("time") or now or time.time()
+        if isinstance(ts, bool) or not isinstance(ts, (int, long, float)) \
+                or not 0 <= ts < TIME_MAX:
+            raise ValueError("bad time %r" % (ts,))
+        if hasattr(sample, "metrics"):
+            points = sample.metrics()
+        else:
+            points = metrics(sample)
+        try:
+            points = [(metric, float(value)) for metric, value in points]
+        except OverflowError:
+            raise ValueError("value too large in %s" % host)
+        return host, ts, points
+
+    def insert(self, prepared, now=None):
+        '''写入 prepare 检查过的数据，返回写入的点数'''
+        if prepared is None:
+            return 0
+        host, ts, points = prepared
+        now = now or time.time()
+        # 不再上报的主机的序列也要定期清理
+        if now - self.expired >= EXPIRE_INTERVAL:
+            self.expire(now)
+        added = 0
+        with self.lock:
+            for metric, value in points:
+                key = (host, metric)
+                series = self.data.get(key)
+                if series is None:
+                    series = self.data[key] = Series(self.capacity,
+                                                    value_type=self.value_type)
+                    self.index.setdefault(metric, set()).add(host)
+                if series.append(ts, value):
+                    added += 1
+                else:
+                    self.dropped += 1
+        return added
+
+    def series(self, host, metric):
+        '''取出一个序列的快照，先丢弃过期的点，没有时返回 None
+        返回的是在锁中复制的快照，可以在锁外读取
+        '''
+        with self.lock:
+            series = self.live_series(host, metric)
+            return series.copy() if series is not None else None
+
+    def live_series(self, host, metric):
+        '''取出正在写入的序列（不复制），先丢弃过期的点，没有时返回 None
+        调用者要持有 self.lock 直到读完（如 tsquery 在锁中计算查询结果）
+        '''
+        series = self.data.get((host, metric))
+        if series is not None and self.retention:
+            series.expire(time.time() - self.retention)
+        return series
+
+    def hosts(self, metric=None):
+        '''所有主机，或者有 metric 这个监控项的主机'''
+        with self.lock:
+            if metric is not None:
+                return sorted(self.index.get(metric, ()))
+            return sorted(set(host for host, metric in self.data))
+
+    def metrics(self, host):
+        with self.lock:
+            return sorted(metric for h, metric in self.data if h == host)
+
+    def expire(self, now=None):
+        '''丢弃所有序列中过期的点，删除空的序列'''
+        if not self.retention:
+            return
+        now = now or time.time()
+        self.expired = now
+        before = now - self.retention
+        with self.lock:
+            for key, series in list(self.data.items()):
+                series.expire(before)
+                if not len(series):
+                    del self.data[key]
+                    hosts = self.index[key[1]]
+                    hosts.discard(key[0])
+                    if not hosts:
+                        del self.index[key[1]]
+
+    def nbytes(self):
+        with self.lock:
+            return sum(series.nbytes() for series in self.data.values())
+
+
+def metrics(sample, prefix=""):
+    '''取出数据中的数字字段 [(监控项, 数值), ...]'''
+    ret = []
+    for key, value in sample.items():
+        if not prefix and key in SKIP_KEYS:
+            continue
+        if isinstance(value, bool):
+            continue
+        if isinstance(value, (int, long, float)):
+            ret.append((prefix + key, value))
+        elif isinstance(value, dict):
+            ret.extend(metrics(value, prefix + key + "."))
+    return ret
+
+
+if __name__ == "__main__":
+    store = Store(capacity=1200)
+    now = int(time.time())
+    for i in range(1200):
+        for host in range(100):
+            store.add({"hostname": "host%d" % host, "CPU": i % 100,
+                       "mem": {"used": i, "free": 1000 - i}}, now - 1200 + i)
+    print "series: %d, memory: %.1fM" % (len(store), store.nbytes() / 1024.0 / 1024)
+    print store.series("host1", "CPU").latest()
+    print store.series("host1", "mem.free").range(now - 3, now)
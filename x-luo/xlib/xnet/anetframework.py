@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""基于 asyncio 的 xnet 协议实现（需要 python 3.7 以上）
+协议和 XNet/cnetutil 完全相同，使用 10 个字节的 ASCII 数字头表示后续数据的长度
+
+服务端的 logic 和 XNet 一样是 logic(data) -> str 的函数，也可以是 async def 函数
+（或者返回 awaitable 的函数），这样 logic 中可以 await 存储和转发，
+一个连接上的多个请求可以同时执行，返回数据按请求的顺序发送
+
+    async def logic(data):
+        await storage.write(data)
+        return "OK"
+
+    server = await start_server(logic, "0.0.0.0", 21002)
+
+客户端可以在一个连接上同时发出多个请求，按顺序匹配返回
+
+    transport, client = await connect("127.0.0.1", 21002)
+    ret = await client.request(data)
+
+xnet 其他模块仍然是 python2 的，这个模块只能在 python3 中使用，
+作为包导入：from xlib.xnet.anetframework import start_server
+"""
+import asyncio
+import inspect
+import logging
+import collections
+
+from .netframe import FrameReader, FrameError, MAX_FRAME, MSG_DATA
+from .netframe import MSG_HELLO, Compressor, pack_head, parse_features
+
+
+def pack(data, version=1, mtype=MSG_DATA, compress=None):
+    '''按协议生成协议头和数据两个 buffer，compress 是协商后的压缩对象'''
+    if not isinstance(data, bytes):
+        data = data.encode("utf-8")
+    flags = 0
+    if compress is not None and version == 2 and mtype != MSG_HELLO:
+        flags, data = compress.compress(data)
+    return (pack_head(len(data), version, mtype, flags), data)
+
+
+class XNetProtocol(asyncio.BufferedProtocol):
+    '''服务端连接
+    数据直接读入 FrameReader 的缓存区（get_buffer/buffer_updated），
+    同时执行的请求超过 max_inflight 时暂停读取
+    协议版本按第一个帧自动判断，返回使用相同的版本
+    compress 为真时允许协商压缩，每个连接有自己的压缩对象（连接上的流）
+    features 是允许协商开启的其他功能（如二进制编码），由 logic 处理
+    '''
+
+    def __init__(self, logic, max_inflight=64, max_frame=MAX_FRAME,
+                 compress=False, features=()):
+        self.logic = logic
+        self.max_inflight = max_inflight
+        self.compress = compress
+        self.features = features
+        self.reader = FrameReader(max_frame=max_frame)
+        self.transport = None
+        # 还没有返回的请求 (future, 消息类型)，按请求顺序排列
+        self.waiting = collections.deque()
+        self.paused = False
+        # 对端已经关闭写，发送完没有返回的请求后关闭连接
+        self.eof = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        return self.reader.buffer(sizehint if sizehint > 0 else 0)
+
+    def buffer_updated(self, nbytes):
+        self.reader.commit(nbytes)
+        try:
+            frames = self.reader.frames()
+        except FrameError as msg:
+            logging.info("***anet: %s close connection***" % msg)
+            self.transport.close()
+            return
+        for mtype, data in frames:
+            if mtype == MSG_HELLO:
+                self.reply(self.hello(data), MSG_HELLO)
+            else:
+                self.dispatch(data)
+        if len(self.waiting) >= self.max_inflight and not self.paused:
+            self.paused = True
+            self.transport.pause_reading()
+
+    def hello(self, data):
+        '''处理客户端的协商帧，返回同意开启的功能列表'''
+        accept = []
+        for feature in parse_features(data):
+            if feature == b"zlib" and self.compress \
+                    and self.reader.version == 2:
+                if self.reader.compress is None:
+                    self.reader.compress = Compressor()
+                accept.append(feature)
+            elif feature in self.features and self.reader.version == 2:
+                accept.append(feature)
+        return b",".join(accept)
+
+    def dispatch(self, data):
+        '''执行 logic'''
+        try:
+            result = self.logic(data)
+        except Exception as msg:
+            logging.info("***anet: logic error(%s) close connection***" % msg)
+            self.transport.close()
+            return
+        self.reply(result)
+
+    def reply(self, result, mtype=MSG_DATA):
+        '''按请求顺序返回，同步的结果在前面没有等待中的请求时直接发送'''
+        if not inspect.isawaitable(result) and not self.waiting:
+            self.transport.writelines(pack(
+                result, self.reader.version, mtype, self.reader.compress))
+            return
+        if inspect.isawaitable(result):
+            future = asyncio.ensure_future(result)
+        else:
+            future = asyncio.get_event_loop().create_future()
+            future.set_result(result)
+        self.waiting.append((future, mtype))
+        future.add_done_callback(self.flush)
+
+    def flush(self, future=None):
+        '''按请求顺序发送已经完成的返回'''
+        if self.transport.is_closing():
+            return
+        while self.waiting and self.waiting[0][0].done():
+            future, mtype = self.waiting.popleft()
+            if future.cancelled() or future.exception() is not None:
+                logging.info("***anet: logic error(%s) close connection***" %
+                             (None if future.cancelled() else future.exception()))
+                self.transport.close()
+                return
+            self.transport.writelines(pack(
+                future.result(), self.reader.version, mtype,
+                self.reader.compress))
+        if self.eof and not self.waiting:
+            self.transport.close()
+            return
+        if self.paused and len(self.waiting) < self.max_inflight:
+            self.paused = False
+            self.transport.resume_reading()
+
+    def eof_received(self):
+        # 对端关闭写后还要把没有返回的请求发送完，最后一个返回发送后在 flush 中关闭
+        self.eof = True
+        return bool(self.waiting)
+
+    def connection_lost(self, exc):
+        for future, mtype in self.waiting:
+            future.cancel()
+        self.waiting.clear()
+
+
+class XNetClient(asyncio.BufferedProtocol):
+    '''客户端连接
+    request 可以连续调用，不需要等待前一个请求返回，返回按顺序匹配
+    version 是使用的协议版本
+    '''
+
+    def __init__(self, version=1, max_frame=MAX_FRAME):
+        self.version = version
+        self.reader = FrameReader(version=version, max_frame=max_frame)
+        self.transport = None
+        self.waiting = collections.deque()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def request(self, data):
+        '''发送一个请求，返回一个 future，结果是服务端返回的数据'''
+        future = asyncio.get_event_loop().create_future()
+        if self.transport is None or self.transport.is_closing():
+            future.set_exception(ConnectionError("xnet connection closed"))
+            return future
+        self.transport.writelines(pack(data, self.version))
+        self.waiting.append(future)
+        return future
+
+    def get_buffer(self, sizehint):
+        return self.reader.buffer(sizehint if sizehint > 0 else 0)
+
+    def buffer_updated(self, nbytes):
+        self.reader.commit(nbytes)
+        try:
+            frames = self.reader.frames()
+        except FrameError as msg:
+            self.transport.close()
+            self._fail(ConnectionError(str(msg)))
+            return
+        for mtype, data in frames:
+            if not self.waiting:
+                self.transport.close()
+                self._fail(ConnectionError("unexpected xnet response"))
+                return
+            future = self.waiting.popleft()
+            if not future.done():
+                future.set_result(data)
+
+    def connection_lost(self, exc):
+        self._fail(exc or ConnectionError("xnet connection closed"))
+
+    def _fail(self, exc):
+        while self.waiting:
+            future = self.waiting.popleft()
+            if not future.done():
+                future.set_exception(exc)
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+
+def start_server(logic, host, port, loop=None, backlog=100,
+                 reuse_port=False, max_inflight=64, max_frame=MAX_FRAME,
+                 compress=True, features=()):
+    '''启动服务端，返回 loop.create_server 的协程，结果是 asyncio.Server
+    可以嵌入到其他 asyncio 服务中：server = await start_server(...)
+    compress 为真时允许 v2 协议的客户端协商开启 zlib 压缩
+    features 是允许协商开启的其他功能（如二进制编码 codec.FEATURE_BIN）
+    '''
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    features = frozenset(features)
+    return loop.create_server(
+        lambda: XNetProtocol(logic, max_inflight, max_frame, compress,
+                             features),
+        host, port, backlog=backlog, reuse_port=reuse_port or None)
+
+
+def connect(host, port, loop=None, version=1, max_frame=MAX_FRAME):
+    '''连接服务端，返回 loop.create_connection 的协程，结果是 (transport, XNetClient)'''
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    return loop.create_connection(
+        lambda: XNetClient(version, max_frame), host, port)
+
+
+def run_server(logic, host, port, **kwargs):
+    '''单独运行服务端'''
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = loop.run_until_complete(
+        start_server(logic, host, port, loop=loop, **kwargs))
+    try:
+        loop.run_forever()
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.close()
+
+
+if __name__ == "__main__":
+    '''反转测试'''
+    def logic(in_data):
+        return in_data[::-1]
+    run_server(logic, "0.0.0.0", 9000)
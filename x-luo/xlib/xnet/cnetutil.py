@@ -1,11 +1,109 @@
 #!/usr/bin/env python
 # coding=utf-8
 
+import time
+import json
+import errno
+import random
+import select
 import socket
+import logging
+import threading
+import collections
+
+from netframe import MAX_FRAME, MSG_DATA, MSG_HELLO, MSG_QUERY
+from netframe import REPLY_OK, REPLY_REJECT
+from netframe import FLAG_AES, Compressor, pack_head
+from netframe import parse_features, FrameReader, FrameWriter, FrameError
+from codec import CODEC_JSON, CODEC_BIN, CODECS, FEATURE_BIN, transcode
+from netcrypt import AuthError, client_hello, client_finish
+
+
+class Rejected(ValueError):
+    """服务端拒绝了数据（REJECT），数据本身有错误，重发或者换主机也不会成功"""
+
+
+def recv_frame(sock, version, max_frame=MAX_FRAME, compress=None,
+               timeout=None, session=None):
+    '''阻塞读取一个帧，返回 (消息类型, 数据)
+    使用和服务端相同的 FrameReader，数据分成多次到达时继续读取，
+    协议头错误、超过最大长度或者加密校验失败时抛出 FrameError（ValueError），
+    连接关闭抛出 socket.error，timeout 秒内没有读完整个帧抛出 socket.timeout
+    '''
+    reader = FrameReader(version=version, max_frame=max_frame)
+    reader.compress = compress
+    reader.session = session
+    return reader.read_frame(sock, timeout)
+
+
+def hello(sock, features, max_frame=MAX_FRAME):
+    '''v2 协议连接建立后协商功能，返回服务端同意开启的功能列表'''
+    payload = b",".join(features)
+    sock.sendall(pack_head(len(payload), 2, MSG_HELLO) + payload)
+    mtype, buf = recv_frame(sock, 2, max_frame)
+    if mtype != MSG_HELLO:
+        raise ValueError
+    return parse_features(buf)
+
+
+def connect(host, port, version=1, max_frame=MAX_FRAME, compress=False,
+            timeout=5, codec=CODEC_JSON, secret_key=None):
+    '''建立连接，v2 协议时按 compress 协商压缩，按 codec 协商数据编码，
+    设置了 secret_key 时协商加密（需要 v2 协议，服务端不同意时抛出 AuthError，不会使用明文）
+    返回 (socket, 压缩对象, 编码, 加密会话)，没有开启压缩/加密时是 None，
+    服务端不支持 codec 时编码是 CODEC_JSON
+    '''
+    features = []
+    nonce = None
+    if secret_key:
+        if version != 2:
+            raise AuthError("encryption needs protocol version 2")
+        token, nonce = client_hello()
+        features.append(token)
+    if version == 2:
+        if compress:
+            features.append(b"zlib")
+        if codec == CODEC_BIN:
+            features.append(FEATURE_BIN)
+    sock = socket.create_connection((host, port), timeout)
+    try:
+        zcomp = session = None
+        accept = hello(sock, features, max_frame) if features else []
+        if b"zlib" in accept:
+            zcomp = Compressor()
+        if nonce is not None:
+            session = client_finish(secret_key, nonce, accept)
+    except BaseException:
+        sock.close()
+        raise
+    return (sock, zcomp, CODEC_BIN if FEATURE_BIN in accept else CODEC_JSON,
+            session)
+
+
+def request(sock, data, version=1, max_frame=MAX_FRAME, zcomp=None,
+            timeout=None, mtype=MSG_DATA, session=None):
+    '''发送一个帧并等待返回，返回服务端返回的数据
+    timeout 是等待并读完返回的总时间
+    mtype 是 v2 协议的消息类型，返回的消息类型不同时抛出 ValueError
+    session 是协商的加密会话，出错后会话的状态和服务端不一致，需要关闭连接
+    '''
+    flags = 0
+    if zcomp is not None:
+        flags, data = zcomp.compress(data)
+    if session is not None:
+        flags |= FLAG_AES
+        data = session.seal(data, mtype, flags)
+    sock.sendall(pack_head(len(data), version, mtype, flags) + data)
+    rtype, buf = recv_frame(sock, version, max_frame, zcomp, timeout, session)
+    if rtype != mtype:
+        raise ValueError("response type %d for request type %d" % (rtype, mtype))
+    return buf
+
 
 # 使用 socket 像多台主机发送数据
 
-def send_data(host_l, data, sock_l, single_host_retry=1):
+def send_data(host_l, data, sock_l, single_host_retry=1, version=1,
+              max_frame=MAX_FRAME, compress=False):
     """
     # host 使用一个列表，以主机名或者 IP 开头后面跟端口
         # 这是假如同时有多个 host（多个 host 写入一个数据库），只要向一个 host 发送成功就可以关闭连接
@@ -32,6 +130,9 @@ def send_data(host_l, data, sock_l, single_host_retry=1):
         In [12]: z
         Out[12]: [2]
     # single_host_retry  发送数据重试次数
+    # version 协议版本，1 是 10 个字节的 ASCII 数字头，2 是二进制协议头（服务端自动识别）
+    # max_frame 返回数据的最大长度
+    # compress 是否协商开启 zlib 压缩（需要 v2 协议），协商结果保存在 sock_l[1]
     # sendData_mh(host_l,"this is data to send")
     """
     # 循环像所有主机发送数据只要一个正确接收返回 True
@@ -46,24 +147,17 @@ def send_data(host_l, data, sock_l, single_host_retry=1):
             try:
                 # 去除 socket 判断 soket 是否存在，不存在这创建
                 if sock_l[0] is None:
-                    sock_l[0] = socket.socket(
-                        socket.AF_INET, socket.SOCK_STREAM)
-                    # 设置阻塞模式下的超时时间，如果超时了会发出一个 socket 超时异常单位是秒
-                    # 注意设置超时链接后 socket 会变成非阻塞模式，.settimeout(None) 变回阻塞模式
-                    sock_l[0].settimeout(5)
-                    sock_l[0].connect((host, port))
+                    # 设置连接的超时时间，如果超时了会发出一个 socket 超时异常单位是秒
+                    # 新连接协商压缩，sock_l[1] 保存压缩对象（没有开启时是 None）
+                    del sock_l[1:]
+                    sock_l[0], zcomp, codec, session = connect(
+                        host, port, version, max_frame, compress)
+                    # 连接成功后变回阻塞模式
                     sock_l[0].settimeout(None)
-                # 发送数据
-                sock_l[0].sendall("%010d%s" % (len(data), data))
-                # 接收数据前 10 个自己计算需要接受的数据大小
-                count = sock_l[0].recv(10)
-                # 如果接收失败发送异常（抛出一个异常进行重试）
-                if not count:
-                    raise ValueError
-                # 统计需要接收数据大小
-                count = int(count)
-                # 接受数据
-                buf = sock_l[0].recv(count)
+                    sock_l.append(zcomp)
+                zcomp = sock_l[1] if len(sock_l) > 1 else None
+                # 发送数据，接收数据前 10 个字节（v2 是 8 个字节）计算需要接受的数据大小
+                buf = request(sock_l[0], data, version, max_frame, zcomp)
                 # 如果数据最后两个字符是 OK 说明已经接收成功，重置计数器，并 return 结果结束程序退出程序
                 if buf == "OK":
                     return True
@@ -71,7 +165,424 @@ def send_data(host_l, data, sock_l, single_host_retry=1):
                 raise socket.error
             # 发生 socket，或者 valueError（如接受的前 10 个字节不是数字）则关闭连接，然后继续重连
             except (socket.error, ValueError) as msg:
-                sock_l[0].close()
+                if sock_l[0] is not None:
+                    sock_l[0].close()
                 sock_l[0] = None
+                del sock_l[1:]
                 retry += 1
+    # 所有主机都发送失败
+    return False
+
+
+class Conn(object):
+    '''Host 的连接池中的一个长连接'''
+
+    def __init__(self):
+        self.sock = None
+        self.zcomp = None
+        # 连接协商的数据编码
+        self.codec = CODEC_JSON
+        # 连接协商的加密会话
+        self.session = None
+        # 同一个连接同时只能有一个请求
+        self.lock = threading.Lock()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+        self.zcomp = None
+        self.codec = CODEC_JSON
+        self.session = None
+
+
+class Host(object):
+    '''XClient 中的一个服务端，保持 size 个长连接，每个连接同时只有一个请求'''
+
+    def __init__(self, host_port, size=1):
+        host, port = host_port.split(':')
+        self.addr = (host, int(port))
+        self.name = host_port
+        self.conns = [Conn() for i in range(max(size, 1))]
+        # 正在等待这个主机返回的请求数
+        self.outstanding = 0
+        # 连续失败次数和恢复重试的时间
+        self.failures = 0
+        self.down_until = 0
+
+    def acquire(self):
+        '''取出一个空闲的连接（已经加锁），都在使用中时等待其中一个'''
+        for conn in self.conns:
+            if conn.lock.acquire(False):
+                return conn
+        conn = random.choice(self.conns)
+        conn.lock.acquire()
+        return conn
+
+    def close(self):
+        '''等正在进行的请求结束后关闭所有连接'''
+        for conn in self.conns:
+            with conn.lock:
+                conn.close()
+
+
+class XClient(object):
+    '''连接多个服务端的客户端，可以在多个线程中共用
+    和每个主机保持最多 pool_size 个长连接（连接池，用到时才建立），每个连接同时只有一个请求，
+    多个线程同时向一个主机发送时使用不同的连接，按 balance 选择主机：
+        round_robin        轮询（每个客户端的起始位置随机，大量 agent 均匀分布）
+        least_outstanding  正在等待返回的请求最少的主机
+    发送失败的主机标记为 down，按 backoff * 2^(失败次数-1) 的时间不再使用
+    （不超过 max_backoff），到期后再次尝试，成功后恢复
+    health_interval 秒检查一次空闲连接是否已经被服务端关闭，并提前重连到期的主机
+    codec 为 "bin" 时和服务端协商二进制编码（需要 v2 协议），send 的数据仍然是
+    每行一个 json 样本，协商成功的连接上转换成二进制编码发送
+    设置了 secret_key 时每个连接协商加密（需要 v2 协议），服务端不同意时不发送
+
+        client = XClient(["10.0.0.1:21002", "10.0.0.2:21002"])
+        client.send(data)
+    '''
+
+    def __init__(self, host_l, balance="round_robin", version=1,
+                 max_frame=MAX_FRAME, compress=False, timeout=5, backoff=1,
+                 max_backoff=60, health_interval=30, codec=CODEC_JSON,
+                 secret_key=None, pool_size=1):
+        if balance not in ("round_robin", "least_outstanding"):
+            raise ValueError("unknown balance %r" % balance)
+        if codec not in CODECS:
+            raise ValueError("unknown codec %r" % codec)
+        self.pool_size = pool_size
+        self.hosts = [Host(host_port, pool_size) for host_port in host_l]
+        self.balance = balance
+        self.version = version
+        self.max_frame = max_frame
+        self.compress = compress
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.health_interval = health_interval
+        self.codec = codec
+        self.secret_key = secret_key or None
+        self.lock = threading.Lock()
+        self.next = random.randrange(len(self.hosts) or 1)
+        self.checked = time.time()
+
+    def pick(self, now):
+        '''按均衡方式排列可用的主机'''
+        with self.lock:
+            # 只在可用的主机中轮询，down 的主机的请求均匀分给其他主机
+            hosts = [host for host in self.hosts if host.down_until <= now]
+            if not hosts:
+                return hosts
+            start = self.next % len(hosts)
+            self.next += 1
+            hosts = hosts[start:] + hosts[:start]
+            if self.balance == "least_outstanding":
+                # 稳定排序，请求数相同时按轮询的顺序
+                hosts.sort(key=lambda host: host.outstanding)
+            return hosts
+
+    def send(self, data):
+        '''发送数据，有一个主机返回 OK 时返回 True，所有可用主机都失败时返回 False
+        主机返回 REJECT 时抛出 Rejected，调用者不应该再重发这份数据
+        '''
+        now = time.time()
+        if now - self.checked >= self.health_interval:
+            self.check(now)
+        for host in self.pick(now):
+            with self.lock:
+                host.outstanding += 1
+            conn = host.acquire()
+            try:
+                reply = self.call(host, conn, data)
+            finally:
+                conn.lock.release()
+                with self.lock:
+                    host.outstanding -= 1
+            if reply == REPLY_OK:
+                return True
+            if reply == REPLY_REJECT:
+                raise Rejected("%s rejected %d bytes" % (host.name, len(data)))
+        return False
+
+    def query(self, query):
+        '''查询服务端的内存时序数据（需要 v2 协议），query 是查询字典
+        返回 {主机: 结果}，所有服务端都失败时返回 None，查询错误时抛出 ValueError
+        只能查到这个服务端收到的数据，服务端是多进程时只有一个进程的数据，
+        需要知道结果是否完整时使用 query_reply
+        '''
+        reply = self.query_reply(query)
+        return reply["result"] if reply is not None else None
+
+    def query_reply(self, query):
+        '''和 query 相同，返回服务端的整个返回 {"result": {主机: 结果}, "partial": 是否只有部分数据}'''
+        if self.version != 2:
+            raise ValueError("query needs protocol version 2")
+        data = json.dumps(query)
+        for host in self.pick(time.time()):
+            conn = host.acquire()
+            try:
+                buf = self.call(host, conn, data, MSG_QUERY)
+            finally:
+                conn.lock.release()
+            if buf is None:
+                continue
+            ret = json.loads(buf)
+            if not ret["ok"]:
+                raise ValueError(ret["error"])
+            ret.setdefault("partial", False)
+            return ret
+        return None
+
+    def call(self, host, conn, data, mtype=MSG_DATA):
+        '''在 host 的一个连接（调用者已经加锁）上发送一个请求，失败时标记 down 并返回 None'''
+        try:
+            if conn.sock is None:
+                self.connect(host, conn)
+            if mtype == MSG_DATA and conn.codec != CODEC_JSON:
+                data = transcode(data, conn.codec)
+            buf = request(conn.sock, data, self.version, self.max_frame,
+                          conn.zcomp, self.timeout, mtype, conn.session)
+        except (socket.error, ValueError) as msg:
+            conn.close()
+            self.mark_down(host, msg)
+            return None
+        # 返回的不是 OK 时是服务端拒绝了数据，连接和主机都是正常的
+        host.failures = 0
+        return buf
+
+    def connect(self, host, conn):
+        '''建立连接并协商'''
+        conn.sock, conn.zcomp, conn.codec, conn.session = connect(
+            host.addr[0], host.addr[1], self.version, self.max_frame,
+            self.compress, self.timeout, self.codec, self.secret_key)
+
+    def mark_down(self, host, msg=None):
+        '''按连续失败次数退避（失败的连接由调用者关闭，其他连接由健康检查关闭）'''
+        host.failures += 1
+        delay = min(self.backoff * 2 ** (host.failures - 1), self.max_backoff)
+        host.down_until = time.time() + delay
+        logging.warning("***xclient: %s down(%s) retry after %ss***" %
+                        (host.name, msg, delay))
+
+    def check(self, now=None):
+        '''健康检查：关闭已经被服务端关闭的空闲连接，
+        down 已经到期的主机提前重连（只重连一个连接，其他连接用到时再建立）
+        '''
+        if now is None:
+            now = time.time()
+        self.checked = now
+        for host in self.hosts:
+            for conn in host.conns:
+                if not conn.lock.acquire(False):
+                    # 正在使用中
+                    continue
+                try:
+                    if conn.sock is not None and not alive(conn.sock):
+                        conn.close()
+                finally:
+                    conn.lock.release()
+            if host.down_until > now or \
+                    any(conn.sock is not None for conn in host.conns):
+                continue
+            conn = host.conns[0]
+            if not conn.lock.acquire(False):
+                continue
+            try:
+                self.connect(host, conn)
+                host.failures = 0
+            except (socket.error, ValueError) as msg:
+                conn.close()
+                self.mark_down(host, msg)
+            finally:
+                conn.lock.release()
+
+    def set_hosts(self, host_l):
+        '''更新服务端列表（如配置重新加载），保留的主机继续使用原来的连接和状态，
+        去掉的主机等正在进行的请求结束后关闭连接
+        '''
+        with self.lock:
+            old = dict((host.name, host) for host in self.hosts)
+            self.hosts = [old.get(host_port) or Host(host_port, self.pool_size)
+                          for host_port in host_l]
+            names = set(host_l)
+            removed = [host for name, host in old.items() if name not in names]
+        for host in removed:
+            host.close()
+
+    def up(self):
+        '''可用的主机'''
+        now = time.time()
+        return [host.name for host in self.hosts if host.down_until <= now]
+
+    def close(self):
+        for host in self.hosts:
+            host.close()
+
+
+class Pipeline(object):
+    '''流水线客户端，在一个连接上同时发送最多 window 个帧，不等待前一个帧的返回，
+    服务端按请求顺序返回，按顺序匹配
+    send 不阻塞（window 已满时返回 False），poll 处理已经到达的返回，
+    flush 阻塞等待所有帧都返回
+
+        pipe = Pipeline("10.0.0.1", 21002, window=32)
+        for data in items:
+            while not pipe.send(data, callback):
+                pipe.poll(1)
+        pipe.flush(10)
+
+    callback(data, reply) 在收到返回时调用，连接断开时没有返回的帧的 reply 是 None，
+    需要由调用者重发（reply 是 REJECT 时不要重发）
+    secret_key 和 XClient 相同，协商加密后 window 中的帧在同一个加密流上依次加密
+    '''
+
+    def __init__(self, host, port, window=32, version=1, max_frame=MAX_FRAME,
+                 compress=False, timeout=5, secret_key=None):
+        self.addr = (host, port)
+        self.window = window
+        self.version = version
+        self.max_frame = max_frame
+        self.compress = compress
+        self.timeout = timeout
+        self.secret_key = secret_key or None
+        self.sock = None
+        self.reader = None
+        self.writer = None
+        # 已经发送还没有返回的 (数据, callback)，按发送顺序排列
+        self.inflight = collections.deque()
+        # 返回不是 OK 或者连接断开的帧数
+        self.failed = 0
+        # 因为连接断开没有返回的帧数，和上次 flush 时的值
+        self.lost = 0
+        self.flushed = 0
+        # 最后一次收发数据的时间，flush 时超过 timeout 没有进展说明服务端已经不返回了
+        self.active = time.time()
+
+    def __len__(self):
+        return len(self.inflight)
+
+    def fileno(self):
+        return self.sock.fileno() if self.sock is not None else -1
+
+    def connect(self):
+        '''建立连接（阻塞，最多 timeout 秒），之后使用非阻塞模式'''
+        sock, zcomp, codec, session = connect(
+            self.addr[0], self.addr[1], self.version, self.max_frame,
+            self.compress, self.timeout, secret_key=self.secret_key)
+        sock.setblocking(0)
+        self.sock = sock
+        self.active = time.time()
+        self.reader = FrameReader(version=self.version, max_frame=self.max_frame)
+        self.writer = FrameWriter(self.version)
+        self.reader.compress = self.writer.compress = zcomp
+        self.reader.session = self.writer.session = session
+
+    def send(self, data, callback=None):
+        '''加入一个帧并尽量发送，不阻塞，window 已满时返回 False'''
+        if len(self.inflight) >= self.window:
+            return False
+        if self.sock is None:
+            self.connect()
+        self.writer.append(data)
+        self.inflight.append((data, callback))
+        self.poll(0)
+        return True
+
+    def poll(self, timeout=0):
+        '''发送缓存的数据并处理已经到达的返回，最多等待 timeout 秒
+        返回这次完成的帧数
+        '''
+        if self.sock is None:
+            return 0
+        try:
+            wlist = [self.sock] if len(self.writer) else []
+            readable, writable, _ = select.select(
+                [self.sock], wlist, [], timeout)
+            if writable:
+                self.write()
+            if readable:
+                return self.read()
+        except (socket.error, select.error, FrameError) as msg:
+            self.fail(msg)
+        return 0
+
+    def write(self):
+        '''非阻塞发送，发送到 socket 缓冲区满为止'''
+        try:
+            while len(self.writer):
+                self.writer.send(self.sock)
+                self.active = time.time()
+        except socket.error as msg:
+            if msg.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def read(self):
+        '''读取并按顺序匹配返回'''
+        try:
+            if not self.reader.recv(self.sock):
+                raise socket.error(errno.ECONNRESET, "connection closed")
+            self.active = time.time()
+        except socket.error as msg:
+            if msg.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        done = 0
+        for mtype, reply in self.reader.frames():
+            if not self.inflight:
+                raise FrameError("unexpected response")
+            data, callback = self.inflight.popleft()
+            if reply != REPLY_OK:
+                self.failed += 1
+            if callback is not None:
+                callback(data, reply)
+            done += 1
+        self.reader.shrink()
+        return done
+
+    def fail(self, msg):
+        '''关闭连接，没有返回的帧都按失败回调'''
+        logging.warning("***pipeline: %s:%s error(%s), %d frames lost***" %
+                        (self.addr[0], self.addr[1], msg, len(self.inflight)))
+        self.close()
+        inflight, self.inflight = self.inflight, collections.deque()
+        self.failed += len(inflight)
+        self.lost += len(inflight)
+        for data, callback in inflight:
+            if callback is not None:
+                callback(data, None)
+
+    def flush(self, timeout=None):
+        '''阻塞等待所有帧都返回，超时或者上次 flush 之后有连接断开时返回 False
+        连接 self.timeout 秒没有收发任何数据时认为服务端已经不返回，关闭连接，
+        没有返回的帧按连接断开处理（计入 lost），从开始 flush 时计时（之前空闲的时间不算）
+        '''
+        begin = time.time()
+        deadline = None if timeout is None else begin + timeout
+        # 先处理已经在 socket 缓冲区中的返回，再判断是否没有进展
+        self.poll(0)
+        while self.inflight and self.sock is not None:
+            now = time.time()
+            stall = max(self.active, begin) + self.timeout - now
+            if stall <= 0:
+                self.fail(socket.timeout("no reply in %ss" % self.timeout))
+                break
+            wait = stall if deadline is None else min(deadline - now, stall)
+            if wait <= 0:
+                return False
+            self.poll(wait)
+        lost, self.flushed = self.lost - self.flushed, self.lost
+        return not self.inflight and not lost
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+
+
+def alive(sock):
+    '''空闲的连接上不应该有数据，可读说明对端已经关闭（或者协议错误）'''
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (select.error, socket.error, ValueError):
         return False
+    return not readable
@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""xnet 数据帧中样本的编码
+默认是每行一个样本的 json（agent 批量发送的格式），
+v2 协议的连接可以在 MSG_HELLO 中协商二进制编码（功能 "bin"），服务端同意后
+客户端在发送时把一个批次的样本编码成一个二进制数据块，服务端按第一个字节自动识别，
+没有协商的连接和 v1 协议的连接仍然使用 json
+
+二进制编码（网络字节序）：
+    编码头  1 字节 magic (0xB1) + 1 字节版本 + 4 字节总长度 + 2 字节字符串数 + 4 字节样本数
+    字符串表  每个是 2 字节长度 + utf-8，监控项名和主机名在一个数据块中只出现一次
+    样本  每个是样本头 + 监控项名序号数组 + 整数数组 + 浮点数数组 + 其他字段
+样本头是样本长度、flags、主机名序号、时间、整数个数、浮点数个数、其他字段长度，
+嵌套字典中的数字按路径展开（路径用 \\x1f 分隔），字符串、布尔值、列表等其他字段是一个 json 对象
+一个数据帧可以是多个数据块连在一起（每个数据块有自己的字符串表）
+
+服务端解码时只检查编码头和每个样本的边界，样本的内容在使用时再解码（Record），
+写入内存时序数据时直接从数组中取出数值，不创建字典，metrics 同时检查整个样本的内容，
+格式错误时抛出 ValueError
+
+存储日志是每行一个 json 样本，二进制编码的数据块不重新序列化，
+base64 后作为一行（LOG_BIN 开头）写入，用 parse_log_line 读取（log_line 生成）
+
+    payload = encode([{"hostname": "h1", "CPU": 12}])
+    for sample in decode(payload):
+        sample.get("hostname"), sample.metrics()
+"""
+import json
+import base64
+import struct
+
+# 协商使用的功能名
+FEATURE_BIN = b"bin"
+CODEC_JSON = "json"
+CODEC_BIN = "bin"
+CODECS = (CODEC_JSON, CODEC_BIN)
+
+BIN_MAGIC = b"\xb1"
+BIN_VERSION = 1
+# magic, 版本, 总长度, 字符串数, 样本数
+BIN_HEAD = struct.Struct("!cBIHI")
+STR_LEN = struct.Struct("!H")
+# 样本长度, flags, 主机名序号, 时间, 整数个数, 浮点数个数, 其他字段长度
+REC_HEAD = struct.Struct("!IBHdHHI")
+# flags
+FLAG_HOST = 0x01
+FLAG_TIME = 0x02
+# 时间是整数
+FLAG_TIME_INT = 0x04
+# 整数数组是 4 字节的（否则 8 字节）
+FLAG_INT32 = 0x08
+# 其他字段中有数字（超出 8 字节整数范围），metrics 需要解析其他字段
+FLAG_TAIL_NUMBER = 0x10
+# 样本数组的格式，按 (整数个数, 浮点数个数, 整数类型) 缓存
+FORMATS = {}
+# 预置的字符串（常见的监控项名），编号在字符串表之前，不需要在每个数据块中发送，
+# 只能在最后追加，修改已有的项要增加 BIN_VERSION
+STATIC_STRINGS = (u"CPU", u"load_avg", u"mem_total", u"mem_usage", u"mem_free",
+                  u"ip")
+# 存储日志中二进制编码的数据块行的前缀（json 的样本行以 "{" 开头）
+LOG_BIN = b"b:"
+# 嵌套字典的路径分隔符，监控项名中使用 "."
+PATH_SEP = u"\x1f"
+INT32_MIN, INT32_MAX = -2 ** 31, 2 ** 31 - 1
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+try:
+    STRING_TYPES = (str, unicode)
+    INT_TYPES = (int, long)
+except NameError:
+    STRING_TYPES = (str,)
+    INT_TYPES = (int,)
+
+
+def is_number(value):
+    return isinstance(value, INT_TYPES + (float,)) and not isinstance(value, bool)
+
+
+def encode(samples):
+    '''把一个批次的样本（字典）编码成二进制数据块，样本不是字典或者太多时抛出 ValueError'''
+    strings = dict((string, i) for i, string in enumerate(STATIC_STRINGS))
+    table = []
+
+    def intern(string):
+        index = strings.get(string)
+        if index is None:
+            index = len(STATIC_STRINGS) + len(table)
+            if index > 0xFFFF:
+                raise ValueError("too many distinct keys")
+            strings[string] = index
+            table.append(string)
+        return index
+
+    records = []
+    for sample in samples:
+        if not isinstance(sample, dict):
+            raise ValueError("sample is not a dict")
+        flags, host, ts = 0, 0, 0.0
+        ikeys, ivals, fkeys, fvals, other, stack = [], [], [], [], {}, []
+        for key, value in sample.items():
+            if key == "hostname" and isinstance(value, STRING_TYPES):
+                flags |= FLAG_HOST
+                host = intern(value)
+            elif key == "time" and is_number(value) and \
+                    (isinstance(value, float) or abs(value) <= 2 ** 53):
+                flags |= FLAG_TIME
+                if not isinstance(value, float):
+                    flags |= FLAG_TIME_INT
+                ts = value
+            else:
+                check_key(key)
+                stack.append((key, value))
+        flatten(stack, intern, ikeys, ivals, fkeys, fvals, other)
+        int_type = "q"
+        if not ivals or INT32_MIN <= min(ivals) and max(ivals) <= INT32_MAX:
+            flags |= FLAG_INT32
+            int_type = "i"
+        tail = b""
+        if other:
+            if any(is_number(value) for value in other.values()):
+                flags |= FLAG_TAIL_NUMBER
+            tail = json.dumps(other).encode("utf-8")
+        body = array_format(len(ikeys), len(fkeys), int_type).pack(
+            *(ikeys + ivals + fkeys + fvals))
+        records.append(REC_HEAD.pack(
+            REC_HEAD.size + len(body) + len(tail), flags, host, ts, len(ikeys),
+            len(fkeys), len(tail)))
+        records.append(body)
+        records.append(tail)
+    parts = []
+    for string in table:
+        data = string.encode("utf-8")
+        parts.append(STR_LEN.pack(len(data)))
+        parts.append(data)
+    parts.extend(records)
+    size = BIN_HEAD.size + sum(len(part) for part in parts)
+    return BIN_HEAD.pack(BIN_MAGIC, BIN_VERSION, size, len(table),
+                         len(samples)) + b"".join(parts)
+
+
+def flatten(stack, intern, ikeys, ivals, fkeys, fvals, other):
+    '''按路径展开一个样本中的字段 stack [(键, 值), ...]（会被清空），
+    数字的序号和数值放进整数/浮点数的数组，其他放进 other
+    用栈代替递归，按类型精确比较（bool 和子类放进 other），是编码的主要开销
+    '''
+    while stack:
+        key, value = stack.pop()
+        cls = type(value)
+        if cls is float:
+            fkeys.append(intern(key))
+            fvals.append(value)
+        elif cls in INT_TYPES and INT64_MIN <= value <= INT64_MAX:
+            ikeys.append(intern(key))
+            ivals.append(value)
+        elif cls is dict and value:
+            for sub, item in value.items():
+                check_key(sub)
+                stack.append((key + PATH_SEP + sub, item))
+        else:
+            other[key] = value
+
+
+def array_format(nints, nfloats, int_type):
+    '''样本数组的 struct：整数的序号和数值，浮点数的序号和数值'''
+    key = (nints, nfloats, int_type)
+    fmt = FORMATS.get(key)
+    if fmt is None:
+        fmt = struct.Struct("!%dH%d%s%dH%dd" % (nints, nints, int_type, nfloats,
+                                                nfloats))
+        if len(FORMATS) < 1024:
+            FORMATS[key] = fmt
+    return fmt
+
+
+def check_key(key):
+    if not isinstance(key, STRING_TYPES) or PATH_SEP in key:
+        raise ValueError("bad key %r" % (key,))
+
+
+def decode(data):
+    '''解码一个数据帧，返回样本的列表
+    二进制编码返回 Record，json 返回每行解析出的对象，格式错误时抛出 ValueError
+    '''
+    if data[:1] == BIN_MAGIC:
+        return decode_bin(data)
+    return [json.loads(line) for line in data.split(b"\n")]
+
+
+def decode_bin(data):
+    '''解析连在一起的数据块，返回所有数据块中的样本'''
+    records = []
+    pos = 0
+    while pos < len(data):
+        pos = decode_block(data, pos, records)
+    return records
+
+
+def decode_block(data, pos, records):
+    '''解析 pos 处一个数据块的编码头、字符串表和样本边界，样本放进 records，
+    样本内容在使用时解码，返回数据块的结束位置
+    '''
+    try:
+        magic, version, size, nstrings, count = BIN_HEAD.unpack_from(data, pos)
+        if magic != BIN_MAGIC:
+            raise ValueError("bad bin magic")
+        if version != BIN_VERSION:
+            raise ValueError("unknown bin codec version %d" % version)
+        if size < BIN_HEAD.size or pos + size > len(data):
+            raise ValueError("bin payload size %d > %d" % (size, len(data) - pos))
+        size += pos
+        pos += BIN_HEAD.size
+        strings = list(STATIC_STRINGS)
+        for i in range(nstrings):
+            length, = STR_LEN.unpack_from(data, pos)
+            pos += STR_LEN.size
+            if pos + length > size:
+                raise ValueError("truncated string table")
+            strings.append(data[pos:pos + length].decode("utf-8"))
+            pos += length
+        names = [string.replace(PATH_SEP, u".") for string in strings]
+        for i in range(count):
+            record = Record(data, pos, strings, names)
+            pos += record.size
+            if pos > size:
+                raise ValueError("truncated sample")
+            records.append(record)
+    except struct.error as msg:
+        raise ValueError("bad bin payload: %s" % msg)
+    if pos != size:
+        raise ValueError("trailing data in bin payload")
+    return pos
+
+
+class Record(object):
+    '''二进制编码中的一个样本，解码时只解析样本头
+    get 取 hostname 和 time 不需要解码其他字段，metrics 直接返回展开的数字监控项
+    '''
+    __slots__ = ("data", "offset", "strings", "names", "size", "flags",
+                 "host", "ts", "nints", "nfloats", "ntail")
+
+    def __init__(self, data, offset, strings, names):
+        self.data = data
+        self.offset = offset
+        self.strings = strings
+        self.names = names
+        (self.size, self.flags, self.host, self.ts, self.nints, self.nfloats,
+         self.ntail) = REC_HEAD.unpack_from(data, offset)
+        body = (2 + (4 if self.flags & FLAG_INT32 else 8)) * self.nints + \
+            10 * self.nfloats
+        if self.size != REC_HEAD.size + body + self.ntail:
+            raise ValueError("bad sample size %d" % self.size)
+        if self.flags & FLAG_HOST and self.host >= len(strings):
+            raise ValueError("bad hostname index %d" % self.host)
+
+    @property
+    def hostname(self):
+        return self.strings[self.host] if self.flags & FLAG_HOST else None
+
+    @property
+    def time(self):
+        if not self.flags & FLAG_TIME:
+            return None
+        return int(self.ts) if self.flags & FLAG_TIME_INT else self.ts
+
+    def get(self, key, default=None):
+        if key == "hostname":
+            value = self.hostname
+        elif key == "time":
+            value = self.time
+        else:
+            return self.to_dict().get(key, default)
+        return default if value is None else value
+
+    def arrays(self):
+        '''解码数组，返回 (序号, 数值)，整数在前浮点数在后'''
+        nints, nfloats = self.nints, self.nfloats
+        values = array_format(nints, nfloats, "i" if self.flags & FLAG_INT32
+                              else "q").unpack_from(self.data,
+                                                    self.offset + REC_HEAD.size)
+        end = 2 * nints + nfloats
+        keys = values[:nints] + values[2 * nints:end]
+        if keys and max(keys) >= len(self.strings):
+            raise ValueError("bad key index %d" % max(keys))
+        return keys, values[nints:2 * nints] + values[end:]
+
+    def other(self):
+        '''字符串等其他字段的字典（键是路径）'''
+        if not self.ntail:
+            return {}
+        end = self.offset + self.size
+        other = json.loads(self.data[end - self.ntail:end].decode("utf-8"))
+        if not isinstance(other, dict):
+            raise ValueError("bad sample tail")
+        return other
+
+    def metrics(self):
+        '''数字监控项 [(监控项, 数值), ...]，嵌套字典按 "key.subkey" 展开
+        其他字段也解析一次，返回时整个样本的内容都是正确的，否则抛出 ValueError
+        '''
+        keys, nums = self.arrays()
+        ret = list(zip(map(self.names.__getitem__, keys), nums))
+        other = self.other()
+        if self.flags & FLAG_TAIL_NUMBER:
+            for path, value in other.items():
+                if is_number(value):
+                    ret.append((path.replace(PATH_SEP, u"."), value))
+        return ret
+
+    def to_dict(self):
+        '''完整解码成和 json 相同的字典，内容错误时抛出 ValueError'''
+        try:
+            return self._to_dict()
+        except (struct.error, TypeError, AttributeError) as msg:
+            raise ValueError("bad sample: %s" % msg)
+
+    def _to_dict(self):
+        sample = {}
+        if self.flags & FLAG_HOST:
+            sample["hostname"] = self.hostname
+        if self.flags & FLAG_TIME:
+            sample["time"] = self.time
+        keys, nums = self.arrays()
+        items = list(zip(map(self.strings.__getitem__, keys), nums))
+        items.extend(self.other().items())
+        for path, value in items:
+            keys = path.split(PATH_SEP)
+            node = sample
+            for key in keys[:-1]:
+                node = node.setdefault(key, {})
+            node[keys[-1]] = value
+        return sample
+
+
+def transcode(data, codec=CODEC_JSON):
+    '''把每行一个 json 样本的数据转换成 codec 编码（一个批次一个数据块），
+    不能转换（不是字典的样本等）时返回原数据（服务端仍然可以按 json 解析）
+    '''
+    if codec != CODEC_BIN:
+        return data
+    try:
+        return encode([json.loads(line) for line in data.split(b"\n")])
+    except ValueError:
+        return data
+
+
+def log_line(data):
+    '''decode 过的数据帧写入存储日志的内容（不含最后的换行）
+    json 是原数据（每行一个样本），二进制编码是 LOG_BIN + base64 的一行
+    '''
+    if data[:1] == BIN_MAGIC:
+        return LOG_BIN + base64.b64encode(data)
+    return data
+
+
+def parse_log_line(line):
+    '''解析存储日志的一行，返回样本字典的列表'''
+    if line.startswith(LOG_BIN):
+        return [record.to_dict() for record in
+                decode_bin(base64.b64decode(line[len(LOG_BIN):]))]
+    return [json.loads(line)]
+
+
+if __name__ == "__main__":
+    '''编码大小和解码性能测试'''
+    import time
+    import zlib
+
+    def sample(i):
+        return {"hostname": "web-%03d.example.com" % (i % 50),
+                "ip": "10.0.%d.%d" % (i % 50, i % 200), "time": 1500000000 + i,
+                "CPU": i % 100, "load_avg": 0.37 + i % 7,
+                "mem_total": 16303740, "mem_usage": 8123456 + i,
+                "mem_free": 8180284 - i,
+                "disk": {"sda": {"util": 12.5, "iops": 340 + i},
+                         "sdb": {"util": 0.5, "iops": i % 10}},
+                "net": {"rx": 123456789 + i, "tx": 98765432 + i}}
+
+    def flat(sample, prefix=""):
+        '''和服务端 tsstore.metrics 相同的展开'''
+        ret = []
+        for key, value in sample.items():
+            if not prefix and key in ("hostname", "time"):
+                continue
+            if is_number(value):
+                ret.append((prefix + key, value))
+            elif isinstance(value, dict):
+                ret.extend(flat(value, prefix + key + "."))
+        return ret
+
+    def bench(name, count, func, rounds=20):
+        begin = time.time()
+        for i in range(rounds):
+            func()
+        cost = (time.time() - begin) / rounds
+        print("%-36s %8.2fus/sample" % (name, cost / count * 1e6))
+
+    for count in (1, 100):
+        samples = [sample(i) for i in range(count)]
+        text = "\n".join(json.dumps(item) for item in samples).encode("utf-8")
+        binary = encode(samples)
+        assert [record.to_dict() for record in decode(binary)] == \
+            [json.loads(line) for line in text.split(b"\n")]
+        print("batch of %d: json %d bytes (zlib %d), bin %d bytes (zlib %d)" % (
+            count, len(text), len(zlib.compress(text)), len(binary),
+            len(zlib.compress(binary))))
+        bench("  json decode", count, lambda: decode(text))
+        bench("  json decode + flatten", count,
+              lambda: [flat(item) for item in decode(text)])
+        bench("  bin decode (lazy)", count, lambda: decode(binary))
+        bench("  bin decode + metrics()", count,
+              lambda: [record.metrics() for record in decode(binary)])
+        bench("  bin decode + to_dict()", count,
+              lambda: [record.to_dict() for record in decode(binary)])
+        bench("  json encode", count,
+              lambda: "\n".join(json.dumps(item) for item in samples))
+        bench("  bin encode", count, lambda: encode(samples))
+        bench("  agent bin (json lines -> transcode)", count,
+              lambda: transcode(text, CODEC_BIN))
+        bench("  server bin (metrics + log_line)", count,
+              lambda: [record.metrics() for record in decode(binary)] and
+              log_line(binary))
+        assert [item for line in log_line(binary).split(b"\n")
+                for item in parse_log_line(line)] == \
+            [json.loads(line) for line in text.split(b"\n")]
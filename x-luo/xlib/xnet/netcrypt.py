@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""xnet 连接级加密
+v2 协议的连接在 MSG_HELLO 中协商加密，双方使用共享的 secret_key 认证一次，
+用双方的随机数派生会话密钥，之后连接上的帧都加密（FLAG_AES），不再每个帧生成 IV、
+创建 cipher、填充和 base64：
+
+    客户端 -> aes:<客户端随机数>,zlib,...
+    服务端 <- zlib,...,aes:<服务端随机数>:<证明>
+    证明 = HMAC(secret_key, "xnet server" + 客户端随机数 + 服务端随机数 + 同意的其他功能)
+
+客户端检查证明确认服务端知道 secret_key，并且同意的功能列表（明文发送）没有被篡改，
+客户端不知道 secret_key 时第一个数据帧的校验就会失败，服务端关闭连接
+协商加密之后连接上不能再有 MSG_HELLO 帧（明文，会绕过加密），收到时关闭连接
+
+每个方向各有一个 AES-CTR 的流（密钥不同），整个连接使用同一个 cipher 对象，
+帧数据依次接在流上加密，输出是原始的二进制（只多 16 字节的校验），
+校验是 HMAC-SHA256(帧序号 + 消息类型 + flags + 密文) 的前 16 字节，
+帧序号不在帧中发送，帧被篡改、重放、删除或者调换顺序时校验都会失败
+seal_many 一次加密多个帧（一次 cipher 调用）
+
+需要 pycrypto 或者 pycryptodome（和 xlib/utils/crypt.py 相同）
+"""
+import os
+import hmac
+import struct
+import hashlib
+import binascii
+
+try:
+    from Crypto.Cipher import AES
+    from Crypto.Util import Counter
+except ImportError:
+    AES = None
+
+# 协商使用的功能名
+FEATURE_AES = b"aes"
+NONCE_SIZE = 16
+TAG_SIZE = 16
+# 帧序号, 消息类型, flags
+TAG_HEAD = struct.Struct("!QHB")
+
+
+class AuthError(ValueError):
+    """加密协商失败（服务端不支持或者 secret_key 不同）"""
+
+
+def kdf(key, label, *parts):
+    '''HMAC-SHA256 派生密钥'''
+    return hmac.new(key, label + b"".join(parts), hashlib.sha256).digest()
+
+
+def check_available():
+    if AES is None:
+        raise AuthError("encryption needs pycrypto or pycryptodome")
+
+
+class StreamCipher(object):
+    '''一个方向的加密流：一个 AES-CTR cipher 和预先设置好密钥的 HMAC'''
+
+    def __init__(self, enc_key, mac_key):
+        self.cipher = AES.new(enc_key, AES.MODE_CTR, counter=Counter.new(128))
+        self.mac = hmac.new(mac_key, digestmod=hashlib.sha256)
+        self.seq = 0
+
+    def tag(self, data, mtype, flags):
+        mac = self.mac.copy()
+        mac.update(TAG_HEAD.pack(self.seq, mtype, flags))
+        mac.update(data)
+        self.seq += 1
+        return mac.digest()[:TAG_SIZE]
+
+
+class Session(object):
+    '''连接的加密会话，FrameReader/FrameWriter 的 session
+    seal 加密发送的帧，open 校验并解密收到的帧，必须按帧的发送/接收顺序调用
+    '''
+
+    def __init__(self, keys, client):
+        send, recv = ("c2s", "s2c") if client else ("s2c", "c2s")
+        self.send = StreamCipher(keys[send + "_enc"], keys[send + "_mac"])
+        self.recv = StreamCipher(keys[recv + "_enc"], keys[recv + "_mac"])
+
+    def seal(self, data, mtype=0, flags=0):
+        '''加密一个帧，返回密文 + 校验，flags 是帧头中的 flags（包括 FLAG_AES）'''
+        data = self.send.cipher.encrypt(data)
+        return data + self.send.tag(data, mtype, flags)
+
+    def seal_many(self, frames):
+        '''一次加密多个帧 [(数据, 消息类型, flags), ...]，返回每个帧的密文 + 校验
+        CTR 模式下拼接后一次加密和依次加密的结果相同
+        '''
+        stream = self.send.cipher.encrypt(b"".join(data for data, mtype, flags
+                                                   in frames))
+        ret = []
+        pos = 0
+        for data, mtype, flags in frames:
+            data = stream[pos:pos + len(data)]
+            pos += len(data)
+            ret.append(data + self.send.tag(data, mtype, flags))
+        return ret
+
+    def open(self, data, mtype=0, flags=0):
+        '''校验并解密一个帧，校验失败时抛出 ValueError（连接需要关闭）'''
+        if len(data) < TAG_SIZE:
+            raise ValueError("encrypted frame too short")
+        body, tag = data[:-TAG_SIZE], data[-TAG_SIZE:]
+        if not hmac.compare_digest(self.recv.tag(body, mtype, flags), tag):
+            raise ValueError("bad frame tag")
+        return self.recv.cipher.decrypt(body)
+
+
+def session_keys(secret, client_nonce, server_nonce):
+    '''从 secret_key 和双方的随机数派生两个方向的加密和校验密钥'''
+    master = kdf(secret, b"xnet session", client_nonce, server_nonce)
+    return dict((name, kdf(master, name.encode("ascii")))
+                for name in ("c2s_enc", "c2s_mac", "s2c_enc", "s2c_mac"))
+
+
+def client_hello():
+    '''客户端的协商功能和随机数：(b"aes:<随机数>", 随机数)'''
+    check_available()
+    nonce = os.urandom(NONCE_SIZE)
+    return FEATURE_AES + b":" + binascii.hexlify(nonce), nonce
+
+
+def server_accept(secret, feature, accept=()):
+    '''服务端处理客户端的 aes 协商功能，返回 (同意的功能, Session)
+    accept 是同意的其他功能（按返回的顺序），包括在证明中
+    '''
+    check_available()
+    try:
+        client_nonce = binascii.unhexlify(feature.split(b":", 1)[1])
+    except (IndexError, TypeError, ValueError, binascii.Error):
+        raise AuthError("bad aes hello")
+    if len(client_nonce) != NONCE_SIZE:
+        raise AuthError("bad aes hello")
+    nonce = os.urandom(NONCE_SIZE)
+    proof = kdf(secret, b"xnet server", client_nonce, nonce, b",".join(accept))
+    reply = b":".join((FEATURE_AES, binascii.hexlify(nonce),
+                       binascii.hexlify(proof)))
+    return reply, Session(session_keys(secret, client_nonce, nonce), False)
+
+
+def client_finish(secret, nonce, accept):
+    '''客户端检查服务端返回的功能列表，返回 Session
+    服务端没有同意加密、证明不对或者功能列表被篡改时抛出 AuthError，不会退回到明文
+    '''
+    others = b",".join(feature for feature in accept
+                       if not feature.startswith(FEATURE_AES + b":"))
+    for feature in accept:
+        if not feature.startswith(FEATURE_AES + b":"):
+            continue
+        try:
+            tag, server_nonce, proof = feature.split(b":")
+            server_nonce = binascii.unhexlify(server_nonce)
+            proof = binascii.unhexlify(proof)
+        except (TypeError, ValueError, binascii.Error):
+            raise AuthError("bad aes hello reply")
+        if not hmac.compare_digest(
+                kdf(secret, b"xnet server", nonce, server_nonce, others), proof):
+            raise AuthError("server failed to authenticate")
+        return Session(session_keys(secret, nonce, server_nonce), True)
+    raise AuthError("server does not accept encryption")
+
+
+if __name__ == "__main__":
+    '''加密性能测试'''
+    import time
+
+    token, nonce = client_hello()
+    reply, server = server_accept(b"secret", token, [b"zlib"])
+    client = client_finish(b"secret", nonce, [b"zlib", reply])
+    try:
+        client_finish(b"secret", nonce, [reply])
+    except AuthError as msg:
+        print("tampered feature list: %s" % msg)
+    sample = b'{"hostname": "meetbill", "CPU": 12, "mem_free": 6711}'
+
+    def bench(name, count, func):
+        begin = time.time()
+        func()
+        cost = time.time() - begin
+        print("%-40s %8.2fus/frame" % (name, cost / count * 1e6))
+
+    count = 100000
+    bench("seal + open", count, lambda: [server.open(client.seal(sample))
+                                         for i in range(count)])
+    bench("seal_many(100) + open", count, lambda: [
+        [server.open(data) for data in client.seal_many([(sample, 0, 0)] * 100)]
+        for i in range(count // 100)])
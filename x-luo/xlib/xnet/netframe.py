@@ -0,0 +1,501 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""xnet 协议的增量解帧
+协议以 10 个 byte 的 ASCII 码数字的头来表示后续数据的长度，例如：
+
+0000000008MEETBILL
+
+v2 协议使用 8 个字节的二进制协议头（网络字节序）：
+    1 字节 magic/版本号 (0xC2)
+    1 字节 flags
+    2 字节 消息类型
+    4 字节 数据长度
+每个连接使用第一个帧的第一个字节判断协议版本（数字是 v1，0xC2 是 v2），
+之后这个连接上的帧都必须是同一个版本，返回数据也使用这个版本
+两个版本的数据长度都不能超过 max_frame，协议头读完就可以拒绝过大的帧
+
+v2 协议的连接可以协商压缩：客户端先发送一个 MSG_HELLO 帧，数据是逗号分隔的
+功能列表（如 "zlib"），服务端返回同意开启的功能，之后数据帧可以使用 zlib 压缩，
+压缩的帧在 flags 中设置 FLAG_ZLIB，小于 min_size 的帧不压缩，
+每个连接的每个方向是一个 zlib 流，压缩的帧必须按顺序解压
+也可以协商加密（功能 "aes"，见 netcrypt.py），之后除 MSG_HELLO 以外的帧都先压缩再加密，
+加密的帧在 flags 中设置 FLAG_AES，加密的连接上收到明文的帧或者 MSG_HELLO 时关闭连接
+
+FrameReader 一次从 socket 读取尽可能多的数据，然后从缓存区中取出所有完整的帧，
+不完整的部分留在缓存区中等待下次读取
+
+FrameWriter 是待发送数据的队列，协议头和数据分开保存，不做拼接，
+发送时使用 memoryview 偏移（支持 sendmsg 时一次发送多个 buffer），不重新切片复制
+"""
+import time
+import zlib
+import errno
+import socket
+import struct
+import itertools
+import collections
+
+# 协议头长度
+HEAD_SIZE = 10
+# v2 协议头
+V2_HEAD = struct.Struct("!BBHI")
+V2_MAGIC = 0xC2
+# 默认的帧数据最大长度
+MAX_FRAME = 16 * 1024 * 1024
+# 消息类型，v1 协议的帧都是 MSG_DATA
+MSG_DATA = 0
+# 连接建立后协商功能
+MSG_HELLO = 1
+# 查询（json），返回也是 MSG_QUERY
+MSG_QUERY = 2
+# logic 对数据帧的返回：OK 已经接收，ERR 暂时失败（客户端稍后重发），
+# REJECT 数据错误（重发也不会成功，客户端不要再重发）
+REPLY_OK = b"OK"
+REPLY_ERR = b"ERR"
+REPLY_REJECT = b"REJECT"
+# flags: 数据使用 zlib 压缩
+FLAG_ZLIB = 0x01
+# flags: 数据使用会话密钥加密
+FLAG_AES = 0x02
+# zlib 预置字典，监控数据中常见的 key，越常见的放在越后面
+ZLIB_DICT = (
+    b'"load_avg": "mem_total": "mem_usage": "mem_free": "time": '
+    b'"ip": "CPU": {"hostname": '
+)
+# 小于这个大小的帧不压缩
+COMPRESS_MIN = 128
+# 预置字典 -> 压缩后的数据（解压流预热用）
+PRIMES = {}
+# 每个连接预分配的读缓存区大小
+READ_BUFF_SIZE = 4096
+# 大帧每次读取时缓存区最多扩大的空间
+READ_CHUNK_SIZE = 1024 * 1024
+# 连接空闲时保留的读缓存区上限，超过则收缩，避免大包过后长期占用内存
+READ_BUFF_KEEP = 64 * 1024
+# sendmsg 一次最多发送的 buffer 数
+IOV_MAX = 64
+# 没有 sendmsg 时，小于这个大小的连续 buffer 合并后发送，减少系统调用
+WRITE_MERGE_SIZE = 4096
+# python2 的 socket 没有 sendmsg
+HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+
+
+class FrameError(ValueError):
+    """协议头错误，收到这个异常后需要关闭连接"""
+
+
+class Compressor(object):
+    '''一个连接的 zlib 流压缩，每个连接协商后创建一个（不能在连接之间共用）
+    每个方向一个 deflate 流，压缩的帧依次接在流上，每个帧以 Z_SYNC_FLUSH 结束，
+    接收方按帧的顺序解压；帧可以引用前面的帧中的内容，不需要每个帧复制压缩对象
+    python2 的 zlib 不支持 zdict 参数，所以先用字典的内容"预热"两个流
+    使用 raw deflate（wbits=-15），没有 zlib 头和校验
+    流在第一次压缩/解压时才创建（只返回 OK 的服务端不占用压缩的内存），
+    压缩流约 256K 内存，解压流约 32K
+    '''
+
+    def __init__(self, zdict=ZLIB_DICT, level=6, min_size=COMPRESS_MIN):
+        self.zdict = zdict
+        self.level = level
+        self.min_size = min_size
+        self.comp = None
+        self.decomp = None
+
+    def compress(self, data):
+        '''返回 (flags, 数据)，太小时不压缩
+        数据已经进入流中，压缩后没有变小也要发送压缩的数据，否则对方的流对不上
+        '''
+        if len(data) < self.min_size:
+            return 0, data
+        if self.comp is None:
+            self.comp = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+            self.comp.compress(self.zdict)
+            self.comp.flush(zlib.Z_SYNC_FLUSH)
+        return FLAG_ZLIB, self.comp.compress(data) + \
+            self.comp.flush(zlib.Z_SYNC_FLUSH)
+
+    def decompress(self, data, max_size=MAX_FRAME):
+        '''解压一个帧（必须按收到的顺序），解压后超过 max_size 时抛出 FrameError'''
+        if self.decomp is None:
+            self.decomp = zlib.decompressobj(-15)
+            self.decomp.decompress(prime(self.zdict))
+        try:
+            out = self.decomp.decompress(data, max_size + 1)
+        except zlib.error as msg:
+            raise FrameError("bad compressed frame: %s" % msg)
+        if len(out) > max_size or self.decomp.unconsumed_tail:
+            raise FrameError("frame too large after decompress")
+        return out
+
+
+def prime(zdict):
+    '''预置字典压缩后的数据，解压流先解压这些数据，之后的历史和压缩流相同'''
+    data = PRIMES.get(zdict)
+    if data is None:
+        comp = zlib.compressobj(6, zlib.DEFLATED, -15)
+        data = PRIMES[zdict] = comp.compress(zdict) + \
+            comp.flush(zlib.Z_SYNC_FLUSH)
+    return data
+
+
+def head_size(version):
+    '''协议头长度'''
+    return V2_HEAD.size if version == 2 else HEAD_SIZE
+
+
+def parse_features(data):
+    '''解析 MSG_HELLO 帧中逗号分隔的功能列表'''
+    return [feature.strip() for feature in data.split(b",") if feature.strip()]
+
+
+def pack_head(length, version=1, mtype=MSG_DATA, flags=0):
+    '''生成协议头'''
+    if version == 2:
+        return V2_HEAD.pack(V2_MAGIC, flags, mtype, length)
+    return b"%010d" % length
+
+
+def parse_head(head, version, max_frame=MAX_FRAME):
+    '''解析协议头，返回 (flags, 消息类型, 数据长度)'''
+    if version == 2:
+        magic, flags, mtype, length = V2_HEAD.unpack_from(head)
+        if magic != V2_MAGIC:
+            raise FrameError("bad frame magic %r" % magic)
+    else:
+        head = bytes(head)
+        # 协议头必须是数字并且大于 0
+        if not head.isdigit() or int(head) <= 0:
+            raise FrameError("bad frame head %r" % head)
+        flags, mtype, length = 0, MSG_DATA, int(head)
+    if length > max_frame:
+        raise FrameError("frame too large %d > %d" % (length, max_frame))
+    return flags, mtype, length
+
+
+class FrameReader(object):
+    '''增量解帧
+    buff 是预分配的 bytearray，通过 recv_into 直接写入
+    [start, end) 是还没有取出的数据
+    version 为 None 时使用第一个帧判断协议版本
+    '''
+
+    def __init__(self, size=READ_BUFF_SIZE, version=None, max_frame=MAX_FRAME):
+        self.version = version
+        self.max_frame = max_frame
+        # 协商开启压缩后是 Compressor 对象
+        self.compress = None
+        # 协商开启加密后是 netcrypt.Session 对象
+        self.session = None
+        self.buff = bytearray(size)
+        # 未处理数据的开始位置
+        self.start = 0
+        # 已写入数据的结束位置
+        self.end = 0
+        # 当前帧（包括协议头）的总长度，协议头还没有读完时为 0
+        self.need = 0
+        # 当前帧的 flags 和消息类型
+        self.flags = 0
+        self.mtype = MSG_DATA
+
+    def __len__(self):
+        return self.end - self.start
+
+    def _reserve(self, size):
+        '''保证缓存区末尾至少有 size 字节的空闲空间
+        先把未处理数据移到缓存区开头，不够时再按倍数扩容
+        '''
+        if len(self.buff) - self.end >= size:
+            return
+        pending = self.end - self.start
+        cap = len(self.buff)
+        while cap - pending < size:
+            cap *= 2
+        if cap == len(self.buff):
+            self.buff[:pending] = self.buff[self.start:self.end]
+        else:
+            buff = bytearray(cap)
+            buff[:pending] = memoryview(self.buff)[self.start:self.end]
+            self.buff = buff
+        self.start = 0
+        self.end = pending
+
+    def buffer(self, size=0):
+        '''返回缓存区空闲部分的 memoryview，写入后调用 commit
+        至少留出 size 和一个预分配大小的空间，大帧按实际收到的数据逐步扩大：
+        每次最多再留出和已收到数据一样多的空间（不超过 READ_CHUNK_SIZE，也不超过帧的剩余部分），
+        不按协议头中声明的长度一次分配，只发来协议头的连接只占用预分配的空间
+        '''
+        if self.start == self.end:
+            self.start = self.end = 0
+        grow = min(self.need - len(self), len(self), READ_CHUNK_SIZE)
+        self._reserve(max(size, READ_BUFF_SIZE, grow))
+        return memoryview(self.buff)[self.end:]
+
+    def commit(self, count):
+        '''buffer 返回的空间中写入了 count 字节'''
+        self.end += count
+
+    def feed(self, data):
+        '''写入已经读取到的数据'''
+        self.buffer(len(data))[:len(data)] = data
+        self.commit(len(data))
+
+    def recv(self, sock):
+        '''从 socket 读取数据，一次读满缓存区的空闲空间
+        返回读到的字节数，返回 0 说明对端已经关闭
+        非阻塞 socket 没有数据时抛出 socket.error（errno 11）
+        '''
+        count = sock.recv_into(self.buffer())
+        self.commit(count)
+        return count
+
+    def wanted(self):
+        '''读完当前帧还需要的字节数，协议头还没有解析时只算到协议头'''
+        if self.need:
+            return self.need - len(self)
+        if self.version is None:
+            # 先读一个字节判断协议版本
+            return 1
+        return max(head_size(self.version) - len(self), 1)
+
+    def read_frame(self, sock, timeout=None):
+        '''阻塞读取一个完整的帧，返回 (消息类型, 数据)
+        每次最多读取当前帧还需要的字节数，不会读到下一个帧，
+        数据分成多次到达时继续读取，缓存区随收到的数据扩大，最多到一个帧的大小（受 max_frame 限制）
+        timeout 是读完整个帧的总时间，超时抛出 socket.timeout，
+        对端关闭时抛出 socket.error
+        '''
+        frame = self.next_frame()
+        if frame is not None:
+            return frame
+        deadline = None if timeout is None else time.time() + timeout
+        old = sock.gettimeout()
+        try:
+            while True:
+                if deadline is not None:
+                    left = deadline - time.time()
+                    if left <= 0:
+                        raise socket.timeout("read frame timeout")
+                    sock.settimeout(left)
+                buff = self.buffer()
+                count = sock.recv_into(buff, min(self.wanted(), len(buff)))
+                if not count:
+                    raise socket.error(errno.ECONNRESET, "connection closed")
+                self.commit(count)
+                frame = self.next_frame()
+                if frame is not None:
+                    return frame
+        finally:
+            if deadline is not None:
+                sock.settimeout(old)
+
+    def _check_version(self):
+        '''使用帧的第一个字节判断或者检查协议版本，不需要等协议头读完'''
+        first = self.buff[self.start]
+        if first == V2_MAGIC:
+            version = 2
+        elif 48 <= first <= 57:
+            version = 1
+        else:
+            raise FrameError("bad frame head %r" % chr(first))
+        if self.version is None:
+            self.version = version
+        elif version != self.version:
+            raise FrameError("frame version %d on version %d connection" %
+                             (version, self.version))
+
+    def next_frame(self):
+        '''取出下一个完整的帧，返回 (消息类型, 数据)，没有完整的帧返回 None'''
+        if not self.need:
+            if not len(self):
+                return None
+            self._check_version()
+            size = head_size(self.version)
+            if len(self) < size:
+                return None
+            head = bytes(self.buff[self.start:self.start + size])
+            self.flags, self.mtype, length = parse_head(
+                head, self.version, self.max_frame)
+            self.need = size + length
+        if len(self) < self.need:
+            return None
+        begin = self.start + head_size(self.version)
+        self.start += self.need
+        self.need = 0
+        # 只在这里复制一次
+        data = memoryview(self.buff)[begin:self.start].tobytes()
+        if self.session is not None and self.mtype == MSG_HELLO:
+            # 协商帧是明文的，加密之后再协商会绕过加密（如重新开启压缩）
+            raise FrameError("hello on encrypted connection")
+        if self.flags & FLAG_AES:
+            if self.session is None:
+                raise FrameError("encrypted frame without negotiation")
+            try:
+                data = self.session.open(data, self.mtype, self.flags)
+            except ValueError as msg:
+                raise FrameError(str(msg))
+        elif self.session is not None:
+            raise FrameError("plaintext frame on encrypted connection")
+        if self.flags & FLAG_ZLIB:
+            if self.compress is None:
+                raise FrameError("compressed frame without negotiation")
+            data = self.compress.decompress(data, self.max_frame)
+        return self.mtype, data
+
+    def frames(self):
+        '''取出缓存区中所有完整的帧，返回 (消息类型, 数据) 的列表'''
+        ret = []
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                return ret
+            ret.append(frame)
+
+    def shrink(self):
+        '''缓存区中没有未处理数据并且超过保留大小时收缩'''
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buff) > READ_BUFF_KEEP:
+                self.buff = bytearray(READ_BUFF_SIZE)
+
+
+class FrameWriter(object):
+    '''待发送数据队列
+    queue 中依次是每个帧的协议头和数据，offset 是队首 buffer 已经发送的字节数
+    version 是发送使用的协议版本
+    '''
+
+    def __init__(self, version=1):
+        self.version = version
+        # 协商开启压缩后是 Compressor 对象，只压缩 v2 协商帧以外的帧
+        self.compress = None
+        # 协商开启加密后是 netcrypt.Session 对象，加密协商帧以外的帧
+        self.session = None
+        self.queue = collections.deque()
+        self.offset = 0
+        # 还需要发送的字节数
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, data, mtype=MSG_DATA, flags=0):
+        '''按协议加入一个帧，协议头和数据分开保存'''
+        self.extend([(data, mtype)], flags)
+
+    def extend(self, frames, flags=0):
+        '''加入多个帧 [(数据, 消息类型), ...]，加密时一次加密所有的帧'''
+        items = []
+        for data, mtype in frames:
+            if not isinstance(data, bytes):
+                data = data.encode("utf-8")
+            fflags = flags
+            if self.compress is not None and self.version == 2 \
+                    and mtype != MSG_HELLO:
+                zflags, data = self.compress.compress(data)
+                fflags |= zflags
+            if self.session is not None and mtype != MSG_HELLO:
+                fflags |= FLAG_AES
+            items.append((data, mtype, fflags))
+        if self.session is not None:
+            sealed = [item for item in items if item[2] & FLAG_AES]
+            if sealed:
+                out = iter(self.session.seal_many(sealed))
+                items = [(next(out), mtype, fflags) if fflags & FLAG_AES
+                         else (data, mtype, fflags)
+                         for data, mtype, fflags in items]
+        for data, mtype, fflags in items:
+            head = pack_head(len(data), self.version, mtype, fflags)
+            self.queue.append(head)
+            self.queue.append(data)
+            self.size += len(head) + len(data)
+
+    def send(self, sock):
+        '''发送一次，返回发送的字节数
+        非阻塞 socket 缓冲区满时抛出 socket.error（errno 11）
+        '''
+        if HAS_SENDMSG:
+            iov = [memoryview(self.queue[0])[self.offset:]]
+            iov.extend(itertools.islice(self.queue, 1, IOV_MAX))
+            count = sock.sendmsg(iov)
+        else:
+            self._merge()
+            count = sock.send(memoryview(self.queue[0])[self.offset:])
+        self._consume(count)
+        return count
+
+    def _merge(self):
+        '''把队首连续的小 buffer 合并成一个，大的 buffer 保持不动'''
+        queue = self.queue
+        if len(queue) < 2 or len(queue[1]) >= WRITE_MERGE_SIZE \
+                or len(queue[0]) - self.offset >= WRITE_MERGE_SIZE:
+            return
+        parts = [queue.popleft()[self.offset:]]
+        size = len(parts[0])
+        self.offset = 0
+        while queue and size + len(queue[0]) <= WRITE_MERGE_SIZE:
+            data = queue.popleft()
+            parts.append(data)
+            size += len(data)
+        queue.appendleft(b"".join(parts))
+
+    def _consume(self, count):
+        '''从队列中去掉已经发送的部分'''
+        self.size -= count
+        queue = self.queue
+        while count:
+            left = len(queue[0]) - self.offset
+            if count < left:
+                self.offset += count
+                return
+            count -= left
+            queue.popleft()
+            self.offset = 0
+
+
+if __name__ == "__main__":
+    '''解帧性能测试'''
+    import threading
+
+    def bench(name, count, func):
+        begin = time.time()
+        func()
+        cost = time.time() - begin
+        print("%-46s %8.3fs %10.0f/s" % (name, cost, count / cost))
+
+    # 一次读到大量小帧
+    frames = b"".join(pack_head(len(b"OK")) + b"OK" for i in range(100000))
+
+    def parse_small():
+        reader = FrameReader()
+        reader.feed(frames)
+        assert len(reader.frames()) == 100000
+    bench("frames() 100000 small frames", 100000, parse_small)
+
+    # 大的返回分成很多小块到达（模拟慢速网络）
+    def chunked(size, chunk, rounds):
+        payload = b"x" * size
+        data = pack_head(len(payload), 2, MSG_DATA) + payload
+        left, right = socket.socketpair()
+
+        def sender():
+            for i in range(rounds):
+                for pos in range(0, len(data), chunk):
+                    left.sendall(data[pos:pos + chunk])
+        thread = threading.Thread(target=sender)
+        thread.start()
+        reader = FrameReader(version=2)
+        for i in range(rounds):
+            mtype, out = reader.read_frame(right, timeout=10)
+            assert len(out) == size
+        thread.join()
+        left.close()
+        right.close()
+
+    bench("read_frame() 4M frame in 1460B chunks x10", 10,
+          lambda: chunked(4 * 1024 * 1024, 1460, 10))
+    bench("read_frame() 64K frame in 1460B chunks x1000", 1000,
+          lambda: chunked(64 * 1024, 1460, 1000))
+    bench("read_frame() 100B frame x20000", 20000,
+          lambda: chunked(100, 1460, 20000))
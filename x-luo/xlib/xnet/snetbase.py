@@ -6,64 +6,188 @@
 
 如果客户端发送 0000000002hi 服务端收到的就是 hi
 然后进程处理后发送给客户端
+客户端一次发送多个帧时，一次读取后会依次处理所有完整的帧
+同时支持 v2 二进制协议头，每个连接按第一个帧自动判断（参考 netframe.py）
 """
 import os
 import sys
 import time
 import errno
+import fcntl
 import socket
 import select
+import threading
+import functools
+import collections
 import multiprocessing
+import multiprocessing.pool
 import logging
 
+from netframe import FrameReader, FrameWriter, FrameError, MAX_FRAME
+from netframe import MSG_DATA, MSG_HELLO, REPLY_ERR
+from netframe import Compressor, parse_features
+from netcrypt import FEATURE_AES, AuthError, server_accept
+from timewheel import TimerWheel
+
+# 默认超时时间（秒），为 0 时不检查
+# head: 开始收到一个帧后，读完协议头的时间
+# body: 读完协议头后，读完数据的时间
+# idle: 没有未处理数据时，等待下一个请求的时间
+# write: 发送返回数据时，两次发送成功之间的时间
+TIMEOUTS = {
+    "head": 30,
+    "body": 60,
+    "idle": 300,
+    "write": 60,
+}
+
+
+def call_logic(logic, frames, handlers=None, resolve=False):
+    '''在线程池/进程池中执行 logic
+    返回 (True, [(消息类型, 返回), ...])，logic 抛出异常时返回 (False, 错误信息)，
+    进程池中 callback 只在成功时调用，所以这里不能让异常抛出去
+    resolve 为真时在这里等待 Deferred 完成（进程池中 Deferred 不能传回主进程）
+    '''
+    try:
+        result = [dispatch(logic, handlers, mtype, data)
+                  for mtype, data in frames]
+        if resolve:
+            result = [(mtype, response.wait())
+                      if isinstance(response, Deferred) else (mtype, response)
+                      for mtype, response in result]
+        return True, result
+    except Exception as msg:
+        return False, "%s: %s" % (type(msg).__name__, msg)
+
+
+def resolve(result):
+    '''[(消息类型, 返回), ...] 转换成发送队列的 [(返回, 消息类型), ...]，Deferred 取出结果'''
+    return [(response.result if isinstance(response, Deferred) else response,
+             mtype) for mtype, response in result]
+
+
+def dispatch(logic, handlers, mtype, data):
+    '''按消息类型执行处理函数，返回 (消息类型, 返回)
+    handlers 中没有的消息类型交给 logic，返回使用和请求相同的消息类型
+    '''
+    if handlers and mtype in handlers:
+        return mtype, handlers[mtype](data)
+    return mtype, logic(data)
+
+
+class Deferred(object):
+    '''logic 的延迟返回
+    logic 返回 Deferred 时不占用 epoll 线程或者池中的线程等待，
+    其他线程（如存储日志的写线程）调用 done(result) 后通过唤醒管道由 epoll 线程发送返回，
+    timeout 秒内没有 done 时返回 timeout_result（由 epoll 线程的定时器触发）
+    进程池中执行时在池的进程中阻塞等待（wait）
+    '''
+
+    def __init__(self, timeout=None, timeout_result=None):
+        self.timeout = timeout
+        self.timeout_result = timeout_result
+        self.result = None
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks = []
+
+    def finished(self):
+        return self.event.is_set()
+
+    def done(self, result):
+        '''设置返回，只有第一次调用有效，返回是否设置成功'''
+        with self.lock:
+            if self.event.is_set():
+                return False
+            self.result = result
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+        return True
+
+    def add_callback(self, callback):
+        '''完成时调用 callback(self)，已经完成时立即调用'''
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def wait(self):
+        '''阻塞等待返回，超时时返回 timeout_result'''
+        if not self.event.wait(self.timeout):
+            self.done(self.timeout_result)
+        return self.result
+
 
 class STATE(object):
     """状态机状态"""
 
-    def __init__(self):
+    def __init__(self, max_frame=MAX_FRAME):
         self.state = 'accept'
-        # 需要读取的字节数
-        self.need_read = 10
         self.need_write = 0
         # 已经收到的字节数
         self.have_read = 0
         self.have_write = 0
 
         # 读写缓存区
-        self.buff_read = ""
-        self.buff_write = ""
+        # 读缓存区使用增量解帧，不完整的帧留在 reader 中等待下次读取
+        self.reader = FrameReader(max_frame=max_frame)
+        # 本次读取到的所有完整的帧，(消息类型, 数据) 的列表
+        self.frames = []
+        # 写缓存区是待发送帧的队列，协议头和数据分开保存
+        self.writer = FrameWriter()
         # socket 对象
         self.sock_obj = ""
         # 客户端连接 IP
         self.sock_addr = ""
-        # 以下使用 check_fd 时才有效
-        # 读取开始时间
-        self.read_stime = None
-        # 默认 read 等待最大超时时间
-        self.read_itime = 30
+        # 当前设置的超时类型，参考 TIMEOUTS
+        self.timer = None
+
+    def reset(self):
+        '''一次请求处理完成后重置状态
+        复用已经分配的读缓存区，缓存区中没有处理的数据要保留
+        '''
+        self.need_write = 0
+        self.have_read = 0
+        self.have_write = 0
+        self.frames = []
+        self.reader.shrink()
 
     def state_log(self):
         '''dbug 显示每个 f 状态'''
+        # 格式化缓存区需要复制数据，没有开启 debug 日志时直接返回
+        if not logging.getLogger().isEnabledFor(logging.DEBUG):
+            return
         msg = (
             '\n current_fd:{fd} \n state:{state}'
-            '\n need_read:{need_read} \n need_write:{need_write}'
+            '\n need_write:{need_write}'
             '\n have_read:{have_read}\n have_write:{have_write}'
-            '\n buff_read:{buff_read} \n buff_write:{buff_write}'
+            '\n buff_read:{buff_read} \n frames:{frames}'
+            '\n buff_write:{buff_write}'
             '\n sock_obj:{sock_obj} \n sock_addr:{sock_addr}'
         ) .format(
             fd=self.sock_obj.fileno(), state=self.state,
-            need_read=self.need_read, need_write=self.need_write,
+            need_write=self.need_write,
             have_read=self.have_read, have_write=self.have_write,
-            buff_read=self.buff_read, buff_write=self.buff_write,
+            buff_read=self.reader.buff[self.reader.start:self.reader.end],
+            frames=len(self.frames), buff_write=list(self.writer.queue),
             sock_obj=self.sock_obj, sock_addr=self.sock_addr
         )
         logging.debug(msg)
 
 
-def bind_socket(addr, port):
-    '''生成监听的 socket'''
+def bind_socket(addr, port, backlog=10, reuseport=False):
+    '''生成监听的 socket
+    backlog: 监听队列长度
+    reuseport: 设置 SO_REUSEPORT，多个进程可以各自监听同一个端口，
+               由内核把新连接分配给不同进程，避免惊群
+    '''
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuseport:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     sock.bind((addr, port))
     """
     # 最大连接数是最大能处理的连接数（accept了丢一边晾着是耍流氓）
@@ -78,7 +202,7 @@ def bind_socket(addr, port):
     #
     # 想要提高服务质量只能通过提高翻桌率（服务器处理速度）来实现。
     """
-    sock.listen(10)
+    sock.listen(backlog)
     return sock
 
 
@@ -87,20 +211,88 @@ class NetBase(object):
     一些基础方法，方便复用
     '''
 
-    def __init__(self, sock, logic):
-        '''初始化对象'''
+    def __init__(self, sock, logic, edge=False, budget=16, timeouts=None,
+                 pool=None, pool_size=0, max_frame=MAX_FRAME, compress=True,
+                 handlers=None, features=None, secret_key=None,
+                 encrypt_only=False):
+        '''初始化对象
+        edge: 是否使用边缘触发（EPOLLET）模式，边缘触发时每个事件会一直 accept/读/写
+              直到 EAGAIN，减少 epoll 返回次数
+        budget: 边缘触发时每个 fd 每次事件最多执行的系统调用次数，用完后放到 pending 中
+              下一轮再处理，防止一个繁忙的连接让其他连接饿死
+        timeouts: 超时时间字典，覆盖 TIMEOUTS 中的默认值
+        pool: 为 "thread" 或 "process" 时 logic 在线程池/进程池中执行，不阻塞 epoll 循环，
+              进程池要求 logic 是模块级的函数（可以被 pickle）
+        pool_size: 池的大小，小于等于 0 时按 cpu 核心数
+        max_frame: 帧数据的最大长度，超过时关闭连接
+        compress: 是否允许 v2 协议的客户端协商开启 zlib 压缩
+        handlers: v2 协议的消息类型 -> 处理函数（如 MSG_QUERY 的查询），
+              返回使用相同的消息类型，其他消息类型的帧交给 logic
+        features: 允许 v2 协议的客户端协商开启的其他功能（如二进制编码 codec.FEATURE_BIN），
+              框架只负责协商，由 logic 处理
+        secret_key: 设置后允许 v2 协议的客户端协商加密（见 netcrypt.py）
+        encrypt_only: 为真时关闭没有协商加密就发送数据的连接
+        '''
+        self.max_frame = max_frame
+        self.handlers = handlers or {}
+        self.features = set(features or ())
+        if isinstance(secret_key, type(u"")):
+            secret_key = secret_key.encode("utf-8")
+        self.secret_key = secret_key or None
+        self.encrypt_only = encrypt_only
+        # 压缩是连接上的流，每个连接协商后创建自己的压缩对象
+        self.compress = compress
+        self.edge = edge
+        self.budget = budget
+        self.timeouts = dict(TIMEOUTS)
+        if timeouts:
+            self.timeouts.update(timeouts)
+        # 连接超时使用时间轮管理，epoll 等待时间不超过下一个定时器到期的时间
+        self.wheel = TimerWheel()
+        # 读写事件掩码
+        self.ev_in = select.EPOLLIN
+        self.ev_out = select.EPOLLOUT
+        if edge:
+            self.ev_in |= select.EPOLLET
+            self.ev_out |= select.EPOLLET
+        # 边缘触发时用完 budget 还没有处理完的 fd，不会再收到 epoll 事件，需要主动处理
+        self.pending = set()
         # 链接状态字典，每个链接根据 socket 连接符建立一个字典，字典中链接状态机
         self.conn_state = {}
         logging.info("init: init listen socket ")
+        # 监听 socket 也要设置为非阻塞，边缘触发时会一直 accept 到 EAGAIN
+        sock.setblocking(0)
         # 使用 setFD 将监听 socket 链接符存入状态机中
         self.setFd(sock)
         # 新建 epoll 事件对象，后续要监控的事件添加到其中
         self.epoll_sock = select.epoll()
         # 第一个参数向 epoll 句柄中注册监听 socket 的可读事件（这个 fd 用于监听）
         # 第二个实用的是一个 epoll 的事件掩码 EPOLLIN 默认是只读
-        self.epoll_sock.register(sock.fileno(), select.EPOLLIN)
+        self.epoll_sock.register(sock.fileno(), self.ev_in)
         # 处理绑定方法
         self.logic = logic
+        # 池中执行完成（或者 Deferred 完成）的结果放入 done 队列，
+        # 并向管道写一个字节唤醒 epoll，由 epoll 线程发送返回数据
+        # deque 的 append/popleft 是线程安全的
+        self.done = collections.deque()
+        self.wake_r, self.wake_w = os.pipe()
+        for wake_fd in (self.wake_r, self.wake_w):
+            flags = fcntl.fcntl(wake_fd, fcntl.F_GETFL)
+            fcntl.fcntl(wake_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.epoll_sock.register(self.wake_r, select.EPOLLIN)
+        self.pool = None
+        self.pool_kind = pool
+        if pool:
+            self.start_pool(pool, pool_size)
+
+    def start_pool(self, pool, pool_size):
+        '''创建执行 logic 的线程池/进程池'''
+        if pool_size <= 0:
+            pool_size = multiprocessing.cpu_count()
+        if pool == "process":
+            self.pool = multiprocessing.Pool(pool_size)
+        else:
+            self.pool = multiprocessing.pool.ThreadPool(pool_size)
 
     def setFd(self, sock, addr=None):
         '''创建状态机初始化状态
@@ -110,7 +302,7 @@ class NetBase(object):
         '''
         logging.info("setFD: crete init state")
         # 创建初始化状态
-        tmp_state = STATE()
+        tmp_state = STATE(self.max_frame)
         tmp_state.sock_obj = sock
         tmp_state.sock_addr = addr
         # conn_states 是这字典使用 soket 连接符（这个 fileno 获取 socket 连接符，是个整数）做 key 链接状态机
@@ -158,62 +350,59 @@ class NetBase(object):
     def read(self, fd):
         '''
         非阻塞模式读取数据 (appcet 执行完后，切换到 read 状态）
-        这里逻辑是这样的 先读 10 个字节头 根据 10 个字节头算出要接受数据的大小
-        然后再次进行读，一直到读完后返回状态 process
+        这里逻辑是这样的 一次读取 socket 中尽可能多的数据，然后由 reader 按
+        10 个字节头取出所有完整的帧，取到帧后返回状态 process，不完整的部分留在
+        reader 中等待下次读取
         '''
         logging.info("read: start read data")
         # 根据传入的 fd 取出 socket
         sock_state = self.conn_state[fd]
         conn = sock_state.sock_obj
         try:
-            # 判断需要读的字节数是不是小于等于 0, 比如客户端发送了 10 个 0 过来（状态机里面的 need_read)
-            if sock_state.need_read <= 0:
-                # 如果小于等于 0 关闭链接将状态机切换到 closing 并执行状态机
-                # 或者直接抛出异常让异常处理关闭连接
-                raise socket.error
-
-            # 进行读取（使用 recv), 因为非阻塞 socket 会发生 socket 11 错误（如缓冲
-            # 区读满）下面异常会处理
-            one_read = conn.recv(sock_state.need_read)
-            # 如果读取的结果为 0 有两种情况
-            # 1 如 epoll 判断有数据需要接受但数据也没有发过来（如 tcp 校验失败）
-            # 2 客户端关闭，tcp 也会发送一个空 FIN 文件过来（如果这种情况下不关闭会有问题
-            # 因为客户端关闭了，epoll 没有关闭信号，如果没有关闭连接进行处理，epoll 会认为
-            # 这个事件没有处理，一直需要读这里就会一直读死循环，造成 cpu 100%)
-            if len(one_read) == 0:
-                raise socket.error
-
-            logging.info("read: read state")
-            # 将收到的数据存入 buff
-            sock_state.buff_read += one_read
-            # 修改已经接受的字节数
-            sock_state.have_read += len(one_read)
-            # 修改还需要读取的字结数
-            sock_state.need_read -= len(one_read)
+            # 边缘触发时一直读到 EAGAIN 或者用完 budget，水平触发时只读一次
+            count = 0
+            while True:
+                try:
+                    # 进行读取（使用 recv_into 直接写入缓存区), 因为非阻塞 socket 会发生
+                    # socket 11 错误（如缓冲区读满）下面异常会处理
+                    one_read = sock_state.reader.recv(conn)
+                except socket.error as msg:
+                    # 已经读到数据后的 EAGAIN 说明这次读完了
+                    if msg.errno == 11 and count:
+                        break
+                    raise
+                # 如果读取的结果为 0 有两种情况
+                # 1 如 epoll 判断有数据需要接受但数据也没有发过来（如 tcp 校验失败）
+                # 2 客户端关闭，tcp 也会发送一个空 FIN 文件过来（如果这种情况下不关闭会有问题
+                # 因为客户端关闭了，epoll 没有关闭信号，如果没有关闭连接进行处理，epoll 会认为
+                # 这个事件没有处理，一直需要读这里就会一直读死循环，造成 cpu 100%)
+                if one_read == 0:
+                    raise socket.error
+
+                logging.info("read: read state")
+                # 修改已经接受的字节数
+                sock_state.have_read += one_read
+                count += 1
+                if not self.edge:
+                    break
+                if count >= self.budget:
+                    self.pending.add(fd)
+                    break
+            # 取出所有完整的帧，协议头错误或者帧超过最大长度时 reader 抛出
+            # FrameError 异常，后面的异常处理就会关闭连接
+            sock_state.frames = sock_state.reader.frames()
+            # 客户端要等协商返回后再发送数据帧，所以数据帧到达时应该已经开启加密
+            if self.encrypt_only and sock_state.reader.session is None and \
+                    any(mtype != MSG_HELLO for mtype, data in sock_state.frames):
+                raise FrameError("plaintext frame on encrypt only server")
+            # 返回数据使用和请求相同的协议版本
+            if sock_state.reader.version:
+                sock_state.writer.version = sock_state.reader.version
             # 读取状态记录到日志
             sock_state.state_log()
 
-            # 先处理前 10 个协议头
-            if sock_state.have_read == 10:
-                logging.info("read: protocol read end")
-                # 判断读取前十个字节是否是数字
-                # 如果不是数字抛出 socket.error 异常，产生这个异常后后面的异常处理就会关闭连接
-                if not sock_state.buff_read.isdigit():
-                    raise socket.error
-                # 假如读取的数小于 0 抛出 socket.error 异常，产生这个异常后后面的异常处理就会关闭连接
-                elif int(sock_state.buff_read) <= 0:
-                    raise socket.error
-                # 计算下次需要读取的大小
-                sock_state.need_read += int(sock_state.buff_read)
-                # 清空缓存
-                sock_state.buff_read = ''
-                # 协议读取完后的状态记录到日志
-                sock_state.state_log()
-                # 读取完完毕后读取内内容
-                return "readcontent"
-
-            # 如果 need_read 等于 0 说明已经读取完毕，可以执行 process 进行处理了
-            elif sock_state.need_read == 0:
+            # 取到了完整的帧说明可以执行 process 进行处理了
+            if sock_state.frames:
                 # 读取完毕了返回 process 进行处理
                 logging.info("read: read end")
                 return "process"
@@ -221,6 +410,10 @@ class NetBase(object):
                 # 如果都不符合说明没有读取完继续读取
                 return "readmore"
 
+        except FrameError as msg:
+            logging.info("***read: soket fd(%s) error(%s) "
+                         "change state to closing***" % (fd, msg))
+            return "closing"
         except socket.error as msg:
             # 这里发生错误如客户端断开连接等要将状态及状态调整为 closing，关闭连接
             # 要单独处理 socket 11 错误时由于比如用户发送的 10 个字节头，但是后面没
@@ -235,21 +428,184 @@ class NetBase(object):
             return "closing"
 
     def process(self, fd):
-        '''使用传入的 logic 方法进行处理'''
+        '''使用传入的 logic 方法依次处理读取到的每个帧，返回按帧的到达顺序加入发送队列
+        协商帧直接在 epoll 线程中处理，两个协商帧之间的数据帧一起处理，
+        设置了线程池/进程池时交给池执行，连接切换到 processing 状态等待执行完成，
+        后面还没有处理的帧留在 sock_state.frames 中，执行完成后继续处理
+        '''
         logging.info("proces: proces start")
         # 读取 socket
         sock_state = self.conn_state[fd]
-        # 获取输入
-        response = self.logic(sock_state.buff_read)
-        # 将获取的输入的字符串获取到后进行拼接写入 buff_write
-        sock_state.buff_write = "%010d%s" % (len(response), response)
+        frames, sock_state.frames = sock_state.frames, []
+        while frames:
+            if frames[0][0] == MSG_HELLO:
+                session = sock_state.reader.session
+                sock_state.writer.append(self.hello(sock_state, frames[0][1]),
+                                         MSG_HELLO)
+                frames = frames[1:]
+                if session is None and sock_state.reader.session is not None \
+                        and frames:
+                    # 和协商帧一起读到的帧是按明文解析的（包括协商帧），
+                    # 客户端应该等协商返回后再发送
+                    logging.info("***process: fd(%s) frames before encryption "
+                                 "established change state to closing***" % fd)
+                    sock_state.state = "closing"
+                    self.state_machine(fd)
+                    return
+                continue
+            # 到下一个协商帧为止的数据帧
+            end = next((i for i, frame in enumerate(frames)
+                        if frame[0] == MSG_HELLO), len(frames))
+            batch, frames = frames[:end], frames[end:]
+            if self.pool is not None:
+                sock_state.frames = frames
+                sock_state.state = "processing"
+                # 执行完成前不监听读写事件（错误和挂断事件仍然会收到）
+                self.epoll_sock.modify(fd, 0)
+                # 连接可能在执行过程中关闭，fd 还会被新连接复用，所以带上状态对象用于确认
+                callback = functools.partial(self.post, fd, sock_state)
+                self.pool.apply_async(call_logic,
+                                      (self.logic, batch, self.handlers,
+                                       self.pool_kind == "process"),
+                                      callback=callback)
+                logging.info("***process: fd(%s) state change to processing***"
+                             % fd)
+                return
+            # 每个帧对应一个返回，按顺序加入发送队列，不做拼接（加密时一次加密）
+            # 和池中执行一样捕获 logic 的异常，只关闭这个连接，不影响 epoll 循环
+            ok, result = call_logic(self.logic, batch, self.handlers)
+            if not ok:
+                self.fail(fd, sock_state, batch[0][0], result)
+                return
+            if self.defer(fd, sock_state, result):
+                # 有没有完成的 Deferred，完成后由 complete 继续处理后面的帧
+                sock_state.frames = frames
+                sock_state.state = "processing"
+                self.epoll_sock.modify(fd, 0)
+                return
+            sock_state.writer.extend(resolve(result))
+        self.respond(fd)
+
+    def fail(self, fd, sock_state, mtype, msg):
+        '''logic 出错：记录日志，尽量发送 REPLY_ERR（之前的返回在它前面）后关闭这个连接
+        mtype 是出错的帧的消息类型（不知道时使用 MSG_DATA）
+        '''
+        logging.error("***process: fd(%s) logic error(%s) change state "
+                      "to closing***" % (fd, msg))
+        try:
+            sock_state.writer.append(REPLY_ERR,
+                                     MSG_DATA if mtype is None else mtype)
+            while len(sock_state.writer):
+                sock_state.writer.send(sock_state.sock_obj)
+        except (socket.error, ValueError):
+            # 缓冲区满或者连接已经断开，直接关闭
+            pass
+        sock_state.state = "closing"
+        self.state_machine(fd)
+
+    def hello(self, sock_state, data):
+        '''处理客户端的协商帧，返回同意开启的功能列表
+        加密最后处理，证明中包括同意的其他功能，客户端可以发现功能列表被篡改
+        '''
+        accept = []
+        aes = None
+        for feature in parse_features(data):
+            if feature == b"zlib" and self.compress \
+                    and sock_state.reader.version == 2:
+                if sock_state.reader.compress is None:
+                    sock_state.reader.compress = Compressor()
+                    sock_state.writer.compress = sock_state.reader.compress
+                accept.append(feature)
+            elif feature in self.features and sock_state.reader.version == 2:
+                accept.append(feature)
+            elif feature.startswith(FEATURE_AES + b":") and self.secret_key \
+                    and sock_state.reader.version == 2 \
+                    and sock_state.reader.session is None:
+                aes = feature
+        if aes is not None:
+            try:
+                reply, session = server_accept(self.secret_key, aes, accept)
+            except AuthError as msg:
+                logging.info("hello: fd(%s) aes error(%s)" %
+                             (sock_state.sock_obj.fileno(), msg))
+            else:
+                sock_state.reader.session = session
+                sock_state.writer.session = session
+                accept.append(reply)
+        logging.info("hello: fd(%s) features %s" %
+                     (sock_state.sock_obj.fileno(), accept))
+        return b",".join(accept)
+
+    def defer(self, fd, sock_state, result):
+        '''返回中有没有完成的 Deferred 时，等它们都完成后再把结果放入 done 队列，
+        返回是否需要等待（在 epoll 线程中调用）
+        '''
+        waiting = [response for mtype, response in result
+                   if isinstance(response, Deferred) and not response.finished()]
+        if not waiting:
+            return False
+        left = [len(waiting)]
+        lock = threading.Lock()
+
+        def finished(deferred):
+            with lock:
+                left[0] -= 1
+                last = left[0] == 0
+            if last:
+                self.post(fd, sock_state, (True, result))
+        for deferred in waiting:
+            if deferred.timeout:
+                # 超时由 epoll 线程的定时器触发（check_timeout）
+                self.wheel.add(deferred, time.time() + deferred.timeout)
+            deferred.add_callback(finished)
+        return True
+
+    def post(self, fd, sock_state, result):
+        '''池中执行完成的回调（在池的线程中执行），放入队列并唤醒 epoll'''
+        self.done.append((fd, sock_state, result))
+        try:
+            os.write(self.wake_w, b"x")
+        except OSError:
+            # 管道写满说明 epoll 线程已经会被唤醒
+            pass
+
+    def complete(self):
+        '''epoll 线程中处理池中执行完成的结果'''
+        try:
+            while os.read(self.wake_r, 4096):
+                pass
+        except OSError:
+            pass
+        while self.done:
+            fd, sock_state, (ok, result) = self.done.popleft()
+            if ok:
+                # 提前完成的 Deferred 不再需要超时定时器，不能留在时间轮中直到超时
+                for mtype, response in result:
+                    if isinstance(response, Deferred):
+                        self.wheel.remove(response)
+            # 连接已经关闭了
+            if self.conn_state.get(fd) is not sock_state:
+                continue
+            if not ok:
+                self.fail(fd, sock_state, None, result)
+                continue
+            if self.defer(fd, sock_state, result):
+                continue
+            sock_state.writer.extend(resolve(result))
+            # 同一次读取中后面还有协商帧和数据帧时继续按顺序处理
+            self.process(fd)
+            self.set_timer(fd)
+
+    def respond(self, fd):
+        '''返回数据已经加入发送队列，切换到 write 状态'''
+        sock_state = self.conn_state[fd]
         # 统计发送字节数
-        sock_state.need_write = len(sock_state.buff_write)
+        sock_state.need_write = len(sock_state.writer)
         # 改变状态机状态
         sock_state.state = "write"
         # 改变 epoll 状态为写状态，改变后 epoll 会收到写信号 epoll 检测到后，会自动执行状
         # 态机不用手动切换
-        self.epoll_sock.modify(fd, select.EPOLLOUT)
+        self.epoll_sock.modify(fd, self.ev_out)
         # 执行完成记录状态机状态
         logging.info("***process: process end fd state change to write***")
         sock_state.state_log()
@@ -260,26 +616,32 @@ class NetBase(object):
         # 取出 socket
         sock_state = self.conn_state[fd]
         conn = sock_state.sock_obj
-        # 定义发送从第几个字节开始
-        last_have_send = sock_state.have_write
         try:
-            logging.info("write: write state")
-            # 取出发送数据 conn.send 会返回发送的字节数
-            have_send = conn.send(sock_state.buff_write[last_have_send:])
-            # 统计已经发送的字节
-            sock_state.have_write += have_send
-            # 计算出还需要发送的字节
-            sock_state.need_write -= have_send
-            # 日志记录发送状态
-            sock_state.state_log()
-            # 判断如果所有数据已经发送完了， 并且已经有发送的字节数
-            if sock_state.need_write == 0 and sock_state.have_write != 0:
-                # 说明已经发送完成
-                logging.info("wirte: write end")
-                return "writecomplete"
-            else:
-                # 如果错误，说明还没有发送完成继续发送
-                return "readmore"
+            # 边缘触发时一直写到 EAGAIN 或者用完 budget，水平触发时只写一次
+            count = 0
+            while True:
+                logging.info("write: write state")
+                # 从发送队列中发送数据，会返回发送的字节数
+                # 发送队列记录了发送到的位置，不需要重新切片
+                have_send = sock_state.writer.send(conn)
+                # 统计已经发送的字节
+                sock_state.have_write += have_send
+                # 计算出还需要发送的字节
+                sock_state.need_write -= have_send
+                # 日志记录发送状态
+                sock_state.state_log()
+                # 判断如果所有数据已经发送完了， 并且已经有发送的字节数
+                if sock_state.need_write == 0 and sock_state.have_write != 0:
+                    # 说明已经发送完成
+                    logging.info("wirte: write end")
+                    return "writecomplete"
+                count += 1
+                if not self.edge:
+                    # 如果错误，说明还没有发送完成继续发送
+                    return "writemore"
+                if count >= self.budget:
+                    self.pending.add(fd)
+                    return "writemore"
 
         except socket.error as msg:
             # 在 send 发送数据时如果 socket 缓冲区满了 epoll 会进入阻塞模式等待再次发送
@@ -300,12 +662,59 @@ class NetBase(object):
         '''取消 epoll 注册，一定要先取消 epoll 注册，再关闭连接
         因为 epoll 运行过快，会发生 socket 关闭，epoll 还没取消注册又收到信号的情况'''
         self.epoll_sock.unregister(fd)
+        self.pending.discard(fd)
+        self.wheel.remove(fd)
         # 关闭 sock
         sock = self.conn_state[fd].sock_obj
         sock.close()
         # 从链接字典中删除这个 fd
         self.conn_state.pop(fd)
 
+    def set_timer(self, fd, force=False):
+        '''根据连接当前的状态设置超时定时器
+        超时类型没有变化时不重新设置（协议头和数据的超时是从开始读取算起的），
+        force 为真时重新计时（发送有进展时使用）
+        '''
+        sock_state = self.conn_state.get(fd)
+        if sock_state is None:
+            # 处理过程中已经关闭了连接
+            return
+        reader = sock_state.reader
+        if sock_state.state == "write":
+            timer = "write"
+        elif sock_state.state == "processing":
+            # logic 执行中不计时（帧已经交给池，reader 通常是空的，要先于 idle 判断）
+            timer = "processing"
+        elif not len(reader):
+            timer = "idle"
+        elif reader.need:
+            timer = "body"
+        else:
+            timer = "head"
+        if timer == sock_state.timer and not force:
+            return
+        sock_state.timer = timer
+        timeout = self.timeouts.get(timer)
+        if timeout:
+            self.wheel.add(fd, time.time() + timeout)
+        else:
+            self.wheel.remove(fd)
+
+    def check_timeout(self):
+        '''关闭所有超时的连接'''
+        for fd in self.wheel.expire():
+            if isinstance(fd, Deferred):
+                # 等待超时的 Deferred 使用 timeout_result 返回
+                fd.done(fd.timeout_result)
+                continue
+            if fd not in self.conn_state:
+                continue
+            sock_state = self.conn_state[fd]
+            logging.info("***timeout: fd(%s) %s timeout change state to "
+                         "closing***" % (fd, sock_state.timer))
+            sock_state.state = "closing"
+            self.state_machine(fd)
+
     def run(self):
         '''运行程序
         监听 epoll 是否有新连接过来
@@ -322,9 +731,23 @@ class NetBase(object):
             # 后面这两种需要关闭 socket
             #  EPOLLERR：表示对应的文件描述符发生错误；
             #  EPOLLHUP：表示对应的文件描述符被挂断；
-            epoll_list = self.epoll_sock.poll()
+            # 还有用完 budget 没处理完的 fd 时不阻塞，否则最多等到下一个定时器到期
+            timeout = 0 if self.pending else self.wheel.timeout()
+            try:
+                epoll_list = self.epoll_sock.poll(timeout)
+            except (IOError, OSError) as msg:
+                # 收到信号（如重新加载配置的 SIGHUP）时 epoll_wait 返回 EINTR
+                if msg.errno == errno.EINTR:
+                    continue
+                raise
+            pending, self.pending = self.pending, set()
             for fd, events in epoll_list:
                 logging.info("epoll: epoll find fd(%s) have signal" % fd)
+                # 池中执行完成（或者 Deferred 完成）的唤醒管道
+                if fd == self.wake_r:
+                    self.complete()
+                    continue
+                pending.discard(fd)
                 sock_state = self.conn_state[fd]
                 # 确认 epoll 状态如果有 io 事件 epoll hang 住则关闭连接
                 if select.EPOLLHUP & events:
@@ -335,24 +758,12 @@ class NetBase(object):
                 logging.info("epoll: use state_machine process fd(%s)" % fd)
                 # 调用状态机
                 self.state_machine(fd)
-
-    def check_fd(self):
-        '''检查 fd 超时
-        如果 read 指定时间呢没有读取到数据择关闭连接
-        需要单独起一个线程进行监控
-        '''
-        while True:
-            for fd in self.conn_state.keys():
-                sock_state = self.conn_state[fd]
-                # fd 是 read 状态并且 read_time 是真的
-                # 判断该 fd 的 epoll 收到数据的等待时间是否超过间隔时间
-                if sock_state.state == "read" and sock_state.read_stime \
-                        and (time.time() - sock_state.read_stime) >= sock_state.read_itime:
-                    # 超过定时器时间关闭该 fd
-                    sock_state.state = "closing"
+            # 上一轮用完 budget 的 fd 继续处理（这一轮处理时可能已经关闭了）
+            for fd in pending:
+                if fd in self.conn_state:
                     self.state_machine(fd)
-            # 超时检查时间
-            time.sleep(60)
+            # 在 epoll 线程中关闭超时的连接
+            self.check_timeout()
 
 
 def fork_processes(num_processes, max_restarts=100):
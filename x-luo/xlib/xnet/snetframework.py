@@ -12,45 +12,65 @@ import select
 import socket
 import logging
 
-from snetbase import NetBase
+from snetbase import NetBase, bind_socket, fork_processes
+from netframe import MAX_FRAME
 
 
 class XNet(NetBase):
     '''Net 处理架构'''
 
-    def __init__(self, sock, logic):
+    def __init__(self, sock, logic, edge=False, budget=16, timeouts=None,
+                 pool=None, pool_size=0, max_frame=MAX_FRAME, compress=True,
+                 handlers=None, features=None, secret_key=None,
+                 encrypt_only=False):
         # 继承父类 init
-        super(XNet, self).__init__(sock, logic)
+        super(XNet, self).__init__(sock, logic, edge, budget, timeouts,
+                                   pool, pool_size, max_frame, compress,
+                                   handlers, features, secret_key,
+                                   encrypt_only)
         # 自定义处理方法
         self.sm = {
             "accept": self.accept2read,
             "read": self.read2process,
             "write": self.write2read,
             "process": self.process,
+            "processing": self.processing,
             "closing": self.close,
         }
 
     def accept2read(self, fd):
-        '''获取 socket，并使 socket 转换为 read 状态'''
-        # 通过父类获取 socket 链接
-        conn_addr = self.accept(fd)
-        # 如果获取到的是 retry 就什么都不操作，让 epoll 判断进行再次读取
-        # 如国获取到了 socket 对象，进行 epoll 注册，创建状态机
-        # 并改变状态机状态为 read
-        if not conn_addr == "retry":
+        '''获取 socket，并使 socket 转换为 read 状态
+        边缘触发时一直 accept 到 EAGAIN 或者用完 budget
+        '''
+        count = 0
+        while True:
+            # 通过父类获取 socket 链接
+            conn_addr = self.accept(fd)
+            # 如果获取到的是 retry（或者其他错误）就什么都不操作，让 epoll 判断进行再次读取
+            if conn_addr == "retry" or conn_addr is None:
+                break
+            # 如国获取到了 socket 对象，进行 epoll 注册，创建状态机
+            # 并改变状态机状态为 read
             conn = conn_addr[0]
             addr = conn_addr[1]
             self.setFd(conn, addr)
-            self.epoll_sock.register(conn.fileno(), select.EPOLLIN)
+            self.epoll_sock.register(conn.fileno(), self.ev_in)
             logging.info(
                 "***chang socket fd(%s) state to read***" %
                 conn.fileno())
             self.conn_state[conn.fileno()].state = "read"
-        else:
-            pass
+            self.set_timer(conn.fileno())
+            count += 1
+            if not self.edge:
+                break
+            if count >= self.budget:
+                self.pending.add(fd)
+                break
 
     def read2process(self, fd):
-        '''处理 read 状态，并传入 proces 进行执行'''
+        '''处理 read 状态，并传入 proces 进行执行
+        一次读取中所有完整的帧都会交给 process 处理
+        '''
         # 获取 read 状态
         try:
             read_ret = self.read(fd)
@@ -61,10 +81,9 @@ class XNet(NetBase):
         # closing 状态关闭连接，如果其他状态不用处理，让 epoll 判担在次读取
         if read_ret == "process":
             self.process(fd)
-        elif read_ret == "readcontent":
-            pass
+            self.set_timer(fd)
         elif read_ret == "readmore":
-            pass
+            self.set_timer(fd)
         elif read_ret == "retry":
             pass
         elif read_ret == "closing":
@@ -74,6 +93,10 @@ class XNet(NetBase):
         else:
             raise Exception("impossible state returned by self.read")
 
+    def processing(self, fd):
+        '''logic 在池中执行，等待 complete 切换到 write 状态'''
+        pass
+
     def write2read(self, fd):
         '''使用 write 发送 process 处理的数据
         处理完后返回 read 状态继续监听客户端发送'''
@@ -83,16 +106,18 @@ class XNet(NetBase):
             write_ret = "closing"
 
         if write_ret == "writemore":
+            # 发送有进展，重新计时
+            self.set_timer(fd, True)
+        elif write_ret == "retry":
             pass
         # 如果已经发送完成调整为 read 状态，改变 epoll 为监听状态继续监听
         elif write_ret == "writecomplete":
-            sock_state = self.conn_state[fd]
-            conn = sock_state.sock_obj
-            addr = sock_state.sock_addr
-            self.setFd(conn, addr)
+            # 重置状态机，继续使用这个连接已经分配的读缓存区
+            self.conn_state[fd].reset()
             logging.info("***chang socket fd(%s) state to read***" % fd)
             self.conn_state[fd].state = "read"
-            self.epoll_sock.modify(fd, select.EPOLLIN)
+            self.epoll_sock.modify(fd, self.ev_in)
+            self.set_timer(fd)
         elif write_ret == "closing":
             self.conn_state[fd].state = 'closing'
             self.state_machine(fd)
@@ -100,16 +125,30 @@ class XNet(NetBase):
             raise Exception("impossible state returned by self.write")
 
 
+def run_workers(addr, port, logic, workers=0, backlog=10, init=None, **kwargs):
+    '''多进程启动
+    先 fork 出 workers 个子进程（小于等于 0 时按 cpu 核心数），每个子进程使用
+    SO_REUSEPORT 创建自己的监听 socket 和 epoll，由内核均衡分配连接，
+    不会像共享一个监听 socket 那样所有进程同时被唤醒
+    父进程只负责重启退出的子进程
+    init 在每个子进程 fork 之后执行（如启动配置文件检查线程）
+    kwargs 传给 XNet（edge, budget, timeouts, pool, pool_size, max_frame,
+    compress, handlers, features, secret_key, encrypt_only）
+    '''
+    fork_processes(workers)
+    if init is not None:
+        init()
+    sock = bind_socket(addr, port, backlog, reuseport=True)
+    XNet(sock, logic, **kwargs).run()
+
+
 if __name__ == "__main__":
     import snetbase
     '''反转测试'''
     def logic(in_data):
         return in_data[::-1]
     '''多进程启动
-    sock = bind_socket("0.0.0.0", 9000)
-    fork_processes(0)
-    reverseD = xNet(sock, logic)
-    reverseD.run()
+    run_workers("0.0.0.0", 9000, logic)
     '''
 
     '''单进程启动'''
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""时间轮定时器
+每个 key（这里是连接的 fd）最多只有一个定时器，添加和删除都是 O(1)
+定时器按到期的刻度放进对应的槽里，每次只检查已经走过的槽，
+超过一圈的定时器留在槽里等下一圈
+"""
+import time
+
+
+class TimerWheel(object):
+    '''哈希时间轮
+    tick: 每个刻度的秒数，定时器最多延迟一个刻度触发
+    slots: 槽的数量，tick * slots 是一圈的时间
+    '''
+
+    def __init__(self, tick=1.0, slots=512):
+        self.tick = tick
+        # 每个槽是 key -> 到期时间的字典
+        self.slots = [{} for i in range(slots)]
+        # key -> 所在槽的下标，用于 O(1) 删除
+        self.timers = {}
+        # 下一个要检查的刻度
+        self.current = int(time.time() / tick)
+
+    def __len__(self):
+        return len(self.timers)
+
+    def add(self, key, deadline):
+        '''设置 key 的定时器，已经存在的定时器会被替换'''
+        self.remove(key)
+        # 向上取整，到达这个刻度时一定已经过了到期时间
+        tick = max(int(-(-deadline // self.tick)), self.current)
+        index = tick % len(self.slots)
+        self.slots[index][key] = deadline
+        self.timers[key] = index
+
+    def remove(self, key):
+        '''删除 key 的定时器'''
+        index = self.timers.pop(key, None)
+        if index is not None:
+            self.slots[index].pop(key, None)
+
+    def expire(self, now=None):
+        '''返回所有已经到期的 key，并删除它们的定时器'''
+        if now is None:
+            now = time.time()
+        end = int(now / self.tick)
+        # 很久没有检查时（比如进程被挂起），最多只需要检查一圈
+        if end - self.current >= len(self.slots):
+            self.current = end - len(self.slots) + 1
+        expired = []
+        while self.current <= end:
+            slot = self.slots[self.current % len(self.slots)]
+            for key, deadline in list(slot.items()):
+                if deadline <= now:
+                    del slot[key]
+                    del self.timers[key]
+                    expired.append(key)
+            self.current += 1
+        return expired
+
+    def timeout(self, now=None):
+        '''距离下一个有定时器的刻度的秒数，可以直接作为 epoll.poll 的超时时间
+        没有定时器时返回 -1（一直等待）
+        '''
+        if not self.timers:
+            return -1
+        if now is None:
+            now = time.time()
+        for i in range(len(self.slots)):
+            tick = self.current + i
+            if self.slots[tick % len(self.slots)]:
+                return max(tick * self.tick - now, 0)
+        return -1